@@ -0,0 +1,203 @@
+""" Benchmarks for ingestion, lookups and message processing.
+
+Run from `src/`, eg. `python bench.py --scales 1 10 100`. Scales above 1 run
+against a synthetic corpus: every real version's `Who.DD`/`Paths.DD` copied
+that many times, each copy under its own `/CopyN/` tree with suffixed names.
+"""
+
+import argparse
+import asyncio
+import os
+import pathlib
+import re
+import shutil
+import tempfile
+import time
+
+import common
+import data
+import index
+import main
+
+QUERY_CLASSES = ("exact symbol", "exact path", "no extension", "wildcard", "not found")
+
+# 1: optional `$LK,"` prefix, 2: symbol name.
+WHO_NAME_PATTERN = re.compile(r"^(\$LK,\")?([\w/:\/.]+)")
+
+# ==============================================================================
+
+def write_synthetic_corpus(directory, scale):
+    """ Write `scale` copies of every TOS version into `directory`/TOS_versions. """
+    for version in common.TOS_VERSIONS:
+        source_dir = common.TOS_VERSIONS_DIR.joinpath(version)
+        target_dir = pathlib.Path(directory).joinpath("TOS_versions", version)
+        target_dir.mkdir(parents=True)
+        shutil.copy(source_dir.joinpath("meta.json"), target_dir)
+
+        with open(source_dir.joinpath("Who.DD"), "r", encoding="latin-1") as f:
+            who_lines = f.readlines()
+        with open(source_dir.joinpath("Paths.DD"), "r", encoding="latin-1") as f:
+            paths_lines = f.readlines()
+
+        with open(target_dir.joinpath("Who.DD"), "w", encoding="latin-1") as who, \
+             open(target_dir.joinpath("Paths.DD"), "w", encoding="latin-1") as paths:
+            for copy in range(scale):
+                if copy == 0:
+                    who.writelines(who_lines)
+                    paths.writelines(paths_lines)
+                    continue
+                suffix_name = lambda m: (m.group(1) or "") + f"{m.group(2)}_{copy}"
+                for line in who_lines:
+                    line = WHO_NAME_PATTERN.sub(suffix_name, line, 1)
+                    who.write(line.replace("FL:C:/", f"FL:C:/Copy{copy}/"))
+                for line in paths_lines:
+                    paths.write(line.replace("C:/", f"C:/Copy{copy}/"))
+
+
+def sample_needles(TOS_version, con, cur, count):
+    """ Return {query class: [needle, ...]} drawn from a version's data. """
+    symbols = data.get_all_symbols(TOS_version, con, cur)
+    files = [p for p in data.get_all_paths(TOS_version, con, cur) if "." in p["basename"]]
+    step_symbols = max(1, len(symbols) // count)
+    step_files = max(1, len(files) // count)
+    return {
+        "exact symbol": [s["name"] for s in symbols[::step_symbols]][:count],
+        "exact path": [p["full_path"] for p in files[::step_files]][:count],
+        "no extension": [p["basename"].split(".")[0].lower() for p in files[::step_files]][:count],
+        "wildcard": [f"*{s['name'][1:4]}*" for s in symbols[::step_symbols]][:count],
+        "not found": [f"{s['name']}Qz" for s in symbols[::step_symbols]][:count],
+    }
+
+
+def time_calls(fn, args_list):
+    """ Call `fn(*args)` for each args; return the latencies in seconds. """
+    latencies = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def report(label, latencies):
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    print(
+        f"  {label:<28}"
+        f" p50 {percentile(latencies, 50) * 1e6:>10.1f}us"
+        f" p90 {percentile(latencies, 90) * 1e6:>10.1f}us"
+        f" p99 {percentile(latencies, 99) * 1e6:>10.1f}us"
+        f" {len(latencies) / total if total else float('inf'):>10.0f}/s"
+    )
+
+# ==============================================================================
+
+def bench_ingestion(snapshot_path, repeat):
+    create = []
+    build = []
+    warm = []
+    load_index = []
+    for _ in range(repeat):
+        create += time_calls(data.create_in_memory_database, [()])
+        if snapshot_path.exists():
+            snapshot_path.unlink()
+        build += time_calls(data.open_database, [(snapshot_path,)])
+        warm += time_calls(data.open_database, [(snapshot_path,)])
+
+        con, cur = data.open_database(snapshot_path)
+        def load_all():
+            lookup_index = index.Index(con, cur)
+            for version in common.TOS_VERSIONS:
+                lookup_index.version_index(version)
+        load_index += time_calls(load_all, [()])
+        con.close()
+
+    print("Startup / ingestion:")
+    report("create_in_memory_database", create)
+    report("open_database (rebuild)", build)
+    report("open_database (snapshot)", warm)
+    report("index.Index (all versions)", load_index)
+
+
+def bench_look_up(con, cur, lookup_index, count):
+    print("Lookups, by query class:")
+    for version in common.TOS_VERSIONS:
+        needles = sample_needles(version, con, cur, count)
+
+        # Both are built apart from the lookups (suggestions in the background).
+        report(f"{version[:10]} first use", time_calls(lookup_index.version_index, [(version,)]))
+        report(
+            f"{version[:10]} suggestion build",
+            time_calls(lookup_index.version_index(version).build_suggestions, [()])
+        )
+        for query_class in QUERY_CLASSES:
+            args = [(version, n) for n in needles[query_class]]
+            report(
+                f"{version[:10]} {query_class} sql",
+                time_calls(lambda v, n: data.look_up(v, n, con, cur), args)
+            )
+            report(
+                f"{version[:10]} {query_class} index",
+                time_calls(lookup_index.look_up, args)
+            )
+
+
+def bench_process_msg(con, cur, count):
+    """ Throughput of whole messages of several needles, cold then warm cache. """
+    needles = sample_needles(common.DEFAULT_TOS_VERSION, con, cur, count)
+    messages = []
+    for i in range(count):
+        picked = [needles[c][i % len(needles[c])] for c in QUERY_CLASSES]
+        messages.append("Have a look at " + " and ".join(f"%%{n}" for n in picked) + ".")
+
+    async def run_all():
+        latencies = []
+        for text in messages:
+            start = time.perf_counter()
+            await main.process_msg(text)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    print(f"process_msg ({len(QUERY_CLASSES)} needles/message):")
+    main.field_cache.clear()
+    report("cold cache", asyncio.run(run_all()))
+    report("warm cache", asyncio.run(run_all()))
+
+
+def bench_scale(scale, count, repeat):
+    print(f"\n=== Scale {scale}x ===")
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        if scale != 1:
+            write_synthetic_corpus(directory, scale)
+            os.chdir(directory)
+        try:
+            common.refresh_TOS_versions()
+            snapshot_path = pathlib.Path(directory).joinpath("index.sqlite3")
+            bench_ingestion(snapshot_path, repeat)
+
+            con, cur = data.open_database(snapshot_path)
+            lookup_index = index.Index(con, cur)
+            bench_look_up(con, cur, lookup_index, count)
+
+            main.set_lookup_index(lookup_index)
+            bench_process_msg(con, cur, count)
+        finally:
+            os.chdir(cwd)
+            common.refresh_TOS_versions()
+            main.set_lookup_index(index.Index(*data.open_database()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--count", type=int, default=200, help="needles per query class")
+    parser.add_argument("--repeat", type=int, default=3, help="ingestion runs per scale")
+    args = parser.parse_args()
+
+    for scale in args.scales:
+        bench_scale(scale, args.count, args.repeat)
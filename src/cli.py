@@ -0,0 +1,138 @@
+""" Look up needles, or the `%%` lookups in text, without Discord; print JSONL.
+
+Run from `src/`, eg.:
+
+    python cli.py needles.txt                      # One needle per line.
+    echo "See %%Cd and %%(TinkerOS)Dir." | python cli.py --text
+    python cli.py --text --jobs 8 posts/*.txt > annotated.jsonl
+
+Each lookup becomes one JSON line, in input order, giving its source, line,
+TOS version, needle, and matching paths and symbols (with their links).
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import itertools
+import json
+import re
+import sys
+
+import cachetools
+
+import common
+import data
+import index
+
+# Set per process by `init_worker()`.
+lookup_index = None
+
+# (TOS version, needle key) -> JSON result fields, without the opening "{".
+result_cache = cachetools.LRUCache(maxsize=65536)
+
+# =============================================================================
+
+def init_worker():
+    global lookup_index
+    lookup_index = index.Index(*data.open_database())
+
+
+def look_up_chunk(items):
+    """ Resolve (source, line, TOS version, needle) items; return JSON lines. """
+    results = {}
+    needles_by_version = collections.defaultdict(list)
+    for i, (_, _, TOS_version, needle) in enumerate(items):
+        key = (TOS_version, index.needle_key(needle))
+        result = result_cache.get(key)
+        if result is None:
+            needles_by_version[TOS_version].append((i, needle))
+        else:
+            results[i] = result
+
+    for TOS_version, needles in needles_by_version.items():
+        version_index = lookup_index.version_index(TOS_version or common.DEFAULT_TOS_VERSION)
+        if version_index is None:
+            for i, _ in needles:
+                results[i] = {"TOS_version": TOS_version, "error": "TOS version not found."}
+            continue
+        matches = lookup_index.look_up_many(version_index.TOS_version, [n for _, n in needles])
+        for (i, _), (paths, symbols) in zip(needles, matches):
+            results[i] = data.matches_as_json(version_index.TOS_version, paths, symbols)
+
+    lines = []
+    for i, (source, line, TOS_version, needle) in enumerate(items):
+        result = results[i]
+        if isinstance(result, dict):
+            # Serialized once; later lines with an equivalent needle reuse it.
+            result = results[i] = json.dumps(result)[1:]
+            result_cache[(TOS_version, index.needle_key(needle))] = result
+        head = json.dumps({"source": source, "line": line, "needle": needle})
+        lines.append(head[:-1] + ", " + result)
+    return lines
+
+
+def read_items(files, text_mode, TOS_version):
+    """ Yield (source, line, TOS version, needle) for every lookup in the input. """
+    for f in files:
+        for line_number, line in enumerate(f, start=1):
+            if text_mode:
+                for version, needle in re.findall(common.LOOKUP_PATTERN, line):
+                    yield f.name, line_number, version or TOS_version, needle
+            else:
+                needle = line.strip()
+                if needle != "":
+                    yield f.name, line_number, TOS_version, needle
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def run(items, out, jobs=1, chunk_size=1000):
+    """ Write the JSON lines for `items` to `out`, in order. """
+    # Build (or check) the snapshot once, before any worker opens it.
+    data.open_database()[0].close()
+
+    if jobs <= 1:
+        init_worker()
+        for chunk in chunked(items, chunk_size):
+            out.writelines(line + "\n" for line in look_up_chunk(chunk))
+        return
+
+    # Keep only a few chunks per worker in flight, so input is read (and
+    # output written) as it goes rather than all held at once.
+    with concurrent.futures.ProcessPoolExecutor(jobs, initializer=init_worker) as executor:
+        pending = collections.deque()
+        for chunk in chunked(items, chunk_size):
+            pending.append(executor.submit(look_up_chunk, chunk))
+            if len(pending) >= jobs * 2:
+                out.writelines(line + "\n" for line in pending.popleft().result())
+        while pending:
+            out.writelines(line + "\n" for line in pending.popleft().result())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "files", nargs="*", type=argparse.FileType("r", encoding="utf-8"),
+        help="input files (default: stdin)"
+    )
+    parser.add_argument(
+        "--text", action="store_true",
+        help="find `%%%%` lookups in text, rather than reading one needle per line"
+    )
+    parser.add_argument(
+        "--version", default="", help="TOS version (default: %s)" % common.DEFAULT_TOS_VERSION
+    )
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="lookups per work unit")
+    args = parser.parse_args()
+
+    run(
+        read_items(args.files or [sys.stdin], args.text, args.version),
+        sys.stdout,
+        jobs=args.jobs,
+        chunk_size=args.chunk_size
+    )
@@ -1,23 +1,128 @@
+import json
+import pathlib
 import re
 
 MAX_LOOKUPS_PER_MESSAGE = 15
 MAX_FIELDS_PER_MESSAGE = 10
 EMBED_ERROR_STR = "[Error]"
 
-TOS_VERSIONS = ["TempleOS_5.3", "TinkerOS"]
+# Number of (TOS version, needle) results kept rendered and ready to send.
+FIELD_CACHE_SIZE = 1024
+
+# Threads that run lookups off the event loop.
+LOOKUP_WORKERS = 4
+
+# Messages with lookups wait in a queue of at most MESSAGE_QUEUE_SIZE for one
+# of MESSAGE_WORKERS tasks to answer them; past that, they're dropped.
+MESSAGE_QUEUE_SIZE = 100
+MESSAGE_WORKERS = 4
+
+# Token buckets: a burst of up to CAPACITY replies, then RATE replies per
+# second, per channel and per user. Discord allows about 5 messages per 5
+# seconds in a channel.
+CHANNEL_BUCKET_CAPACITY = 5
+CHANNEL_BUCKET_RATE = 1
+USER_BUCKET_CAPACITY = 3
+USER_BUCKET_RATE = 0.5
+
+# The same lookups by the same user in the same channel this soon after are
+# answered only once.
+COALESCE_SECONDS = 5
+
+# A channel whose messages get dropped is told so at most once this often.
+SHED_NOTICE_SECONDS = 60
+
+# Replies are remembered, to be edited or deleted along with the message they
+# answer, for this long; at most this many; on disk across restarts if persisted.
+REPLY_STORE_TTL_SECONDS = 24 * 60 * 60
+REPLY_STORE_SIZE = 10_000
+PERSIST_REPLIES = True
+# Persisted changes are written out this often, off the event loop.
+REPLY_STORE_FLUSH_SECONDS = 5
+
+# A message's edits are answered this long after the first one, as one edit.
+EDIT_DEBOUNCE_SECONDS = 1
+
+# Append a line per answered message to this file, for `replay.py` (None:
+# don't): its lookups, result counts and stage timings. Messages slower than
+# SLOW_QUERY_SECONDS also get each lookup's plan. Written by a thread of its
+# own, flushed at least this often.
+QUERY_LOG_PATH = None
+SLOW_QUERY_SECONDS = 0.25
+QUERY_LOG_FLUSH_SECONDS = 5
+
+# Set by `shards.py` in each shard process it starts: the Discord shards this
+# process runs (SHARD_IDS), out of SHARD_COUNT in total. None: unsharded.
+SHARD_IDS = None
+SHARD_COUNT = None
+
+# Commands only the bot's owner can run, eg. `%%!reload`. These never match
+# LOOKUP_PATTERN, as "!" can't start a needle.
+ADMIN_COMMAND_PREFIX = "%%!"
+RELOAD_COMMAND = ADMIN_COMMAND_PREFIX + "reload"
+STATS_COMMAND = ADMIN_COMMAND_PREFIX + "stats"
+# Registers (or updates) the `/ttd` slash command with Discord; needed once,
+# and after it changes.
+SYNC_COMMAND = ADMIN_COMMAND_PREFIX + "sync"
+
+# Serve Prometheus-style metrics at http://METRICS_HOST:METRICS_PORT/metrics
+# (None: don't serve them; `%%!stats` still works).
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None
+
+# Serve the HTTP/JSON lookup service (see `server.py`) from the bot's own
+# process and index (None: don't). It can also be run on its own.
+HTTP_HOST = "127.0.0.1"
+HTTP_PORT = None
+
+# Loaded versions not queried for this long are dropped from memory (None: never).
+VERSION_IDLE_EVICT_SECONDS = 6 * 60 * 60
+
 DEFAULT_TOS_VERSION = "TempleOS_5.3"
 
-TOS_VERSION_BASE_URL_MAP = {
-    "TempleOS_5.3": "https://tinkeros.github.io/WbTempleOS",
-    "TinkerOS": "https://tinkeros.github.io/WbGit"
-}
+# `%%(*)X` looks X up in every version at once.
+ALL_TOS_VERSIONS = "*"
+
+# Every `TOS_versions/<name>/` with a `meta.json` is a version. Filled in by
+# `refresh_TOS_versions()`, in place, so imported references stay current.
+TOS_VERSIONS_DIR = pathlib.Path("TOS_versions")
+TOS_VERSIONS = []
+TOS_VERSION_BASE_URL_MAP = {}
+
+
+def read_TOS_versions():
+    """ Return {TOS version: base URL} as on disk now, without applying it. """
+    base_urls = {}
+    for meta_path in sorted(TOS_VERSIONS_DIR.glob("*/meta.json")):
+        with open(meta_path, "r") as f:
+            base_urls[meta_path.parent.name] = json.load(f)["base_url"]
+    return base_urls
+
+
+def refresh_TOS_versions(base_urls=None):
+    """ Make `base_urls` (default: as read now) the known TOS versions. """
+    if base_urls is None:
+        base_urls = read_TOS_versions()
+    TOS_VERSION_BASE_URL_MAP.clear()
+    TOS_VERSION_BASE_URL_MAP.update(base_urls)
+    TOS_VERSIONS[:] = base_urls
+
+
+refresh_TOS_versions()
 
 # Patterns =====================================================================
 
+# A needle: never a trailing ".", which ends a sentence rather than a file name.
+# Slash command needles are checked against it whole.
+NEEDLE_PATTERN = re.compile(r"[\w:\/\.\*-]+(?<!\.)")
+
 # 1: TOS version (if applicable), 2: needle.
 # Eg. %%(TinkerOS)Cd -> 1: "TinkerOS", 2: "Cd".
 # Eg. %%DocClear -> 1: None, 2: "DocClear".
-LOOKUP_PATTERN = re.compile(r"(?:^|\s)%%(?:\(([\w\.]+)\))?([\w:\/\.\*-]+(?<!\.))")
+# Eg. %%(*)Cd -> 1: "*", 2: "Cd".
+LOOKUP_PATTERN = re.compile(
+    r"(?:^|\s)%%(?:\(([\w\.]+|\*)\))?(" + NEEDLE_PATTERN.pattern + ")"
+)
 
 BASENAME_NO_EXTENSIONS_PATTERN = re.compile(r"/?([\w-]+)(?:\.\w+)*$")
 
@@ -1,59 +1,200 @@
+import hashlib
+import logging
+import os
+import pathlib
 import re
 import sqlite3
 import random
+import sys
+import threading
+
+import appdirs
 
 import common
 
+log = logging.getLogger(__name__)
+
+# Bump whenever the table layout changes so stale snapshots get rebuilt.
+SNAPSHOT_FORMAT_VERSION = 3
+SNAPSHOT_PATH = pathlib.Path(appdirs.user_cache_dir("TTD2_bot")).joinpath("index.sqlite3")
+
 # 1: name, 2: file (if applicable), 3: line (if applicable), 4: type.
 SYMBOL_PATTERN = re.compile(r"^(?:\$LK,\")?([\w/:\/.]+)(?:\s*\",A=\"FL:[A-Z]:([/\w\.]+),(\d+)\S+)?.*? ((?:[A-Z][a-z].*|NULL)) $")
 
 # 1: full path.
 PATH_PATTERN = re.compile(r"^\$LK,\"[A-Z]:([\w/\.-]+)")
 
+# Records ======================================================================
+
+# Shared tables for the few distinct symbol/path types and definition files,
+# so records hold a small int each instead of their own string.
+TYPE_NAMES = []
+FILE_NAMES = [None]
+codes_lock = threading.Lock()
+type_codes = {}
+file_codes = {None: 0}
+
+
+def intern_code(s, codes, names):
+    code = codes.get(s)
+    if code is None:
+        with codes_lock:
+            code = codes.get(s)
+            if code is None:
+                names.append(sys.intern(s))
+                code = codes[s] = len(names) - 1
+    return code
+
+
+class Record:
+    """ A compact row (slots, interned strings) that reads like the dict it replaced.
+
+    `link` and `field_text` are rendered from the other fields at ingestion
+    (see `render_symbol()`/`render_path()`). They can be read like fields, but
+    aren't among `keys()` and don't count towards equality.
+    """
+
+    __slots__ = ("link", "field_text")
+    DERIVED_FIELDS = ("link", "field_text")
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS and key not in self.DERIVED_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self.FIELDS and key not in self.DERIVED_FIELDS:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return self.FIELDS
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return dict(self) == dict(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def as_json(self):
+        """ Fields (but TOS version, known from context) and link, for JSON output. """
+        fields = dict(self)
+        del fields["TOS_version"]
+        fields["link"] = self.link
+        return fields
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)!r})"
+
+
+def matches_as_json(TOS_version, path_matches, symbol_matches):
+    """ A lookup's results, as JSON-ready values. """
+    return {
+        "TOS_version": TOS_version,
+        "found": bool(path_matches or symbol_matches),
+        "paths": [p.as_json() for p in path_matches],
+        "symbols": [s.as_json() for s in symbol_matches],
+    }
+
+
+class SymbolRecord(Record):
+    __slots__ = ("name", "file_code", "line", "type_code", "TOS_version")
+    FIELDS = ("name", "file", "line", "type", "TOS_version")
+
+    def __init__(self, name, file, line, type, TOS_version=None, link=None, field_text=None):
+        self.name = sys.intern(name)
+        self.file_code = intern_code(file, file_codes, FILE_NAMES)
+        self.line = line
+        self.type_code = intern_code(type, type_codes, TYPE_NAMES)
+        self.TOS_version = TOS_version and sys.intern(TOS_version)
+        self.link = link
+        self.field_text = field_text
+
+    @property
+    def file(self):
+        return FILE_NAMES[self.file_code]
+
+    @property
+    def type(self):
+        return TYPE_NAMES[self.type_code]
+
+
+class PathRecord(Record):
+    __slots__ = ("full_path", "basename", "type_code", "is_compressed", "TOS_version")
+    FIELDS = ("full_path", "basename", "type", "is_compressed", "TOS_version")
+
+    def __init__(
+        self, full_path, basename, type, is_compressed, TOS_version=None, link=None,
+        field_text=None
+    ):
+        self.full_path = sys.intern(full_path)
+        self.basename = sys.intern(basename)
+        self.type_code = intern_code(type, type_codes, TYPE_NAMES)
+        self.is_compressed = bool(is_compressed)
+        self.TOS_version = TOS_version and sys.intern(TOS_version)
+        self.link = link
+        self.field_text = field_text
+
+    @property
+    def type(self):
+        return TYPE_NAMES[self.type_code]
+
 # =============================================================================
 
-def get_symbols(TOS_version):
-    symbols = []
-    with open(f"TOS_versions/{TOS_version}/Who.DD", "r", encoding="latin-1") as f:
-        for line in f.readlines():
-            m = re.match(SYMBOL_PATTERN, line)
-            if m is not None:
-                symbol = {
-                    "name": m.group(1),
-                    "file": m.group(2),
-                    "line": m.group(3),
-                    "type": m.group(4)
-                }
-                symbols.append(symbol)
-            else:
-                raise
-
-    return symbols
+def read_lines(source_path):
+    """ Yield (line number, line) from a TOS data file, one line at a time. """
+    with open(source_path, "r", encoding="latin-1") as f:
+        yield from enumerate(f, start=1)
 
 
-def get_bare_paths(TOS_version):
-    """ Return all paths on system containing a file. Infers parent dirs. """
-    paths = []
-    with open(f"TOS_versions/{TOS_version}/Paths.DD", "r", encoding="latin-1") as f:
-        for line in f.readlines():
-            file_path = re.match(PATH_PATTERN, line).group(1)
-            paths.append(file_path)
+def report_malformed_line(source_path, line_number, line):
+    log.warning("Skipping malformed line %s:%d: %r", source_path, line_number, line)
 
-            # Infer parent dirs; `FF("*");` output is only filepaths.
-            parent_dir_paths = []
-            splits = file_path.split("/")
-            for i in range(0, len(splits)):
-                parent_dir_paths.append("/".join(splits[:-i]))
 
-            for dir_path in parent_dir_paths:
-                if dir_path not in paths:
-                    paths.append(dir_path)
+def get_symbols(TOS_version):
+    """ Yield a record for every parseable symbol in a version's `Who.DD`. """
+    source_path = f"TOS_versions/{TOS_version}/Who.DD"
+    for line_number, line in read_lines(source_path):
+        m = SYMBOL_PATTERN.match(line)
+        if m is None:
+            report_malformed_line(source_path, line_number, line)
+            continue
 
-        paths.append("/")
-        return paths
+        yield SymbolRecord(m.group(1), m.group(2), m.group(3), m.group(4), TOS_version)
 
 
-def path_expand_info(path):
+def get_bare_paths(TOS_version):
+    """ Yield all paths on system containing a file, once each. Infers parent dirs. """
+    source_path = f"TOS_versions/{TOS_version}/Paths.DD"
+    seen = set()
+    for line_number, line in read_lines(source_path):
+        m = PATH_PATTERN.match(line)
+        if m is None:
+            report_malformed_line(source_path, line_number, line)
+            continue
+
+        file_path = m.group(1)
+        if file_path in seen:
+            continue
+        seen.add(file_path)
+        yield file_path
+
+        # Infer parent dirs; `FF("*");` output is only filepaths. Once a
+        # parent has been seen, all of its own parents have been too.
+        dir_path = file_path.rpartition("/")[0]
+        while dir_path != "" and dir_path not in seen:
+            seen.add(dir_path)
+            yield dir_path
+            dir_path = dir_path.rpartition("/")[0]
+
+    yield "/"
+
+
+def path_expand_info(path, TOS_version=None):
     extension_type_map = {
         "HC": "HolyC",
         "HH": "HolyC Header",
@@ -78,19 +219,15 @@ def path_expand_info(path):
     except IndexError:
         file_type = "Directory"
 
-    return {
-        "full_path": path,
-        "basename": basename,
-        "type": file_type,
-        "is_compressed": is_compressed
-    }
+    return PathRecord(path, basename, file_type, is_compressed, TOS_version)
 
 
 def get_paths(TOS_version):
-    return [path_expand_info(p) for p in get_bare_paths(TOS_version)]
+    return (path_expand_info(p, TOS_version) for p in get_bare_paths(TOS_version))
 
 
-def path_to_link(bare_path, line, TOS_version):
+def path_to_link(bare_path, line, TOS_version, base_urls=None):
+    """ `base_urls`: {TOS version: base URL}; default `common.TOS_VERSION_BASE_URL_MAP`. """
     path = path_expand_info(bare_path)
     if bare_path == "/":
         url_basename = ""
@@ -100,7 +237,9 @@ def path_to_link(bare_path, line, TOS_version):
         url_basename = path["basename"]
 
     url_end = "/".join(path["full_path"].split("/")[:-1]+[url_basename])
-    base_url = common.TOS_VERSION_BASE_URL_MAP[TOS_version]
+    if base_urls is None:
+        base_urls = common.TOS_VERSION_BASE_URL_MAP
+    base_url = base_urls[TOS_version]
 
     if line is None:
         url_line = ""
@@ -109,9 +248,94 @@ def path_to_link(bare_path, line, TOS_version):
 
     return base_url + url_end + url_line
 
+# Rendering ====================================================================
+
+OPCODE_FIELD_TEXT = """
+Reference: [x86 reference: {name}](https://www.felixcloutier.com/x86/{name_lower})
+
+See [::/Doc/ASM.DD.Z](https://tinkeros.github.io/WbTempleOS/Doc/Asm.html)
+And [::/Compliler/OpCodes.DD.Z](https://tinkeros.github.io/WbTempleOS/Compiler/OpCodes.html)\n
+"""
+REG_FIELD_TEXT = "Reference: [Wikibooks: x86 Architecture]({})\n".format(
+    "https://en.wikibooks.org/wiki/X86_Assembly/X86_Architecture"
+    + "#General-Purpose_Registers_(GPR)_-_16-bit_naming_conventions"
+)
+
+
+def version_prefix(TOS_version):
+    if TOS_version != common.DEFAULT_TOS_VERSION:
+        return f"(Version: {TOS_version})\n"
+    return ""
+
+
+def render_symbol(symbol, base_urls=None):
+    """ Fill in a symbol's `link` and embed `field_text`; return the symbol. """
+    TOS_version = symbol["TOS_version"]
+    text = version_prefix(TOS_version)
+    text += f"Type: {symbol['type']}\n"
+
+    if symbol["type"] == "OpCode":
+        text += OPCODE_FIELD_TEXT.format(name=symbol["name"], name_lower=symbol["name"].lower())
+    elif symbol["type"] == "Reg":
+        text += REG_FIELD_TEXT
+    elif symbol["file"] is not None:
+        symbol.link = path_to_link(symbol["file"], symbol["line"], TOS_version, base_urls)
+        line_str = ", line " + str(symbol["line"])
+        text += f"Definition: [{symbol['file']}{line_str}]({symbol.link})\n"
+
+    symbol.field_text = text
+    return symbol
+
+
+def render_path(path, base_urls=None):
+    """ Fill in a path's `link` and embed `field_text`; return the path. """
+    path.link = path_to_link(path["full_path"], None, path["TOS_version"], base_urls)
+    path.field_text = (
+        version_prefix(path["TOS_version"])
+        + f"Type: {path['type']}\nPath: [{path['full_path']}]({path.link})"
+    )
+    return path
+
+
+def render_cross_version_symbol(symbol, lines, base_urls=None):
+    """ Like `render_symbol()`, for a symbol found in several versions.
+
+    `lines` is [(TOS version, line)] for every version that has the symbol;
+    versions that disagree on the line get a definition link each.
+    """
+    text = f"Versions: {', '.join(v for v, _ in lines)}\n"
+    text += f"Type: {symbol['type']}\n"
+
+    if symbol["type"] == "OpCode":
+        text += OPCODE_FIELD_TEXT.format(name=symbol["name"], name_lower=symbol["name"].lower())
+    elif symbol["type"] == "Reg":
+        text += REG_FIELD_TEXT
+    elif symbol["file"] is not None:
+        versions_by_line = {}
+        for TOS_version, line in lines:
+            versions_by_line.setdefault(line, []).append(TOS_version)
+        for line, line_versions in versions_by_line.items():
+            link = path_to_link(symbol["file"], line, line_versions[0], base_urls)
+            symbol.link = symbol.link or link
+            label = "" if len(versions_by_line) == 1 else f" ({', '.join(line_versions)})"
+            text += f"Definition{label}: [{symbol['file']}, line {line}]({link})\n"
+
+    symbol.field_text = text
+    return symbol
+
+
+def render_cross_version_path(path, TOS_versions, base_urls=None):
+    """ Like `render_path()`, for a path found in all of `TOS_versions`. """
+    path.link = path_to_link(path["full_path"], None, TOS_versions[0], base_urls)
+    path.field_text = (
+        f"Versions: {', '.join(TOS_versions)}\n"
+        + f"Type: {path['type']}\nPath: [{path['full_path']}]({path.link})"
+    )
+    return path
+
 # =============================================================================
 
-def create_in_memory_database():
+def create_in_memory_database(base_urls=None):
     con = sqlite3.connect(":memory:")
     cur = con.cursor()
 
@@ -122,82 +346,189 @@ def create_in_memory_database():
             full_path     TEXT NOT NULL COLLATE NOCASE,
             basename      TEXT NOT NULL COLLATE NOCASE,
             type          TEXT NOT NULL COLLATE NOCASE,
-            is_compressed BOOLEAN NOT NULL
+            is_compressed BOOLEAN NOT NULL,
+            link          TEXT NOT NULL,
+            field_text    TEXT NOT NULL
         ); 
-        CREATE INDEX `PATH`
-        ON `paths` (`full_path` COLLATE NOCASE, `TOS_version`);
-
-        CREATE INDEX `BASENAME`
-        ON `paths` (`basename` COLLATE NOCASE, `TOS_version`);
 
         CREATE TABLE symbols(
             TOS_version TEXT NOT NULL COLLATE NOCASE,
             name        TEXT NOT NULL COLLATE NOCASE,
             file        TEXT COLLATE NOCASE,
             line        INTEGER,
-            type        TEXT NOT NULL COLLATE NOCASE
+            type        TEXT NOT NULL COLLATE NOCASE,
+            link        TEXT,
+            field_text  TEXT NOT NULL
         );
-        CREATE INDEX `SYMBOL_NAME`
-        ON `symbols` (`name` COLLATE NOCASE, `TOS_version`);
         """
     )
 
-    for version in ["TinkerOS", "TempleOS_5.3"]:
-        for path in get_paths(version):
-            cur.execute(
+    # Rows stream straight from the files into a single transaction, each
+    # rendered on the way so lookups only gather prebuilt strings.
+    with con:
+        for version in common.TOS_VERSIONS if base_urls is None else base_urls:
+            cur.executemany(
                 """
                 INSERT INTO paths(
-                    TOS_version, full_path, basename, type, is_compressed
+                    TOS_version, full_path, basename, type, is_compressed, link, field_text
                 )
-                VALUES (?, ?, ?, ?, ?) """,
+                VALUES (?, ?, ?, ?, ?, ?, ?) """,
                 (
-                    version,
-                    path["full_path"],
-                    path["basename"],
-                    path["type"],
-                    path["is_compressed"]
+                    (
+                        version,
+                        path["full_path"],
+                        path["basename"],
+                        path["type"],
+                        path["is_compressed"],
+                        path.link,
+                        path.field_text
+                    )
+                    for path in (render_path(p, base_urls) for p in get_paths(version))
                 )
             )
 
-        for symbol in get_symbols(version):
-            cur.execute(
+            cur.executemany(
                 """
                 INSERT INTO symbols(
-                    TOS_version, name, file, line, type
+                    TOS_version, name, file, line, type, link, field_text
                 )
-                VALUES (?, ?, ?, ?, ?) """,
+                VALUES (?, ?, ?, ?, ?, ?, ?) """,
                 (
-                    version,
-                    symbol["name"],
-                    symbol["file"],
-                    symbol["line"],
-                    symbol["type"]
+                    (
+                        version,
+                        symbol["name"],
+                        symbol["file"],
+                        symbol["line"],
+                        symbol["type"],
+                        symbol.link,
+                        symbol.field_text
+                    )
+                    for symbol in (render_symbol(s, base_urls) for s in get_symbols(version))
                 )
             )
-        con.commit()
+
+    # Indexing once after the bulk load is cheaper than on every insert.
+    cur.executescript(
+        """
+        CREATE INDEX `PATH`
+        ON `paths` (`full_path` COLLATE NOCASE, `TOS_version`);
+
+        CREATE INDEX `BASENAME`
+        ON `paths` (`basename` COLLATE NOCASE, `TOS_version`);
+
+        CREATE INDEX `SYMBOL_NAME`
+        ON `symbols` (`name` COLLATE NOCASE, `TOS_version`);
+        """
+    )
 
     return con, cur
 
+# Snapshots ====================================================================
+
+def get_source_checksums(base_urls=None):
+    """ Return {source: SHA-256} for everything a snapshot is built from.
+
+    That's every TOS version's .DD files and `meta.json` (its base URL is
+    in every link), plus the default version (which rendering leaves out).
+    """
+    checksums = {}
+    for version in common.TOS_VERSIONS if base_urls is None else base_urls:
+        for name in ("Who.DD", "Paths.DD", "meta.json"):
+            source_path = f"TOS_versions/{version}/{name}"
+            with open(source_path, "rb") as f:
+                checksums[source_path] = hashlib.sha256(f.read()).hexdigest()
+    checksums["common.DEFAULT_TOS_VERSION"] = hashlib.sha256(
+        common.DEFAULT_TOS_VERSION.encode()
+    ).hexdigest()
+    return checksums
+
+
+def build_snapshot(snapshot_path=SNAPSHOT_PATH, base_urls=None):
+    """ Write the parsed database to disk, tagged with its source checksums. """
+    con, cur = create_in_memory_database(base_urls)
+    cur.execute("CREATE TABLE snapshot_sources(file TEXT PRIMARY KEY, sha256 TEXT NOT NULL)")
+    cur.executemany(
+        "INSERT INTO snapshot_sources(file, sha256) VALUES (?, ?)",
+        get_source_checksums(base_urls).items()
+    )
+    cur.execute(f"PRAGMA user_version = {SNAPSHOT_FORMAT_VERSION}")
+    con.commit()
+
+    # Write beside the target then rename, so readers never see a partial file.
+    snapshot_path = pathlib.Path(snapshot_path)
+    snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = snapshot_path.with_name(f"{snapshot_path.name}.{os.getpid()}.tmp")
+    disk_con = sqlite3.connect(tmp_path)
+    with disk_con:
+        con.backup(disk_con)
+    disk_con.close()
+    con.close()
+    os.replace(tmp_path, snapshot_path)
+
+
+def open_snapshot(snapshot_path=SNAPSHOT_PATH, base_urls=None):
+    """ Open a snapshot read-only; return None if missing, stale or corrupt. """
+    snapshot_path = pathlib.Path(snapshot_path)
+    if not snapshot_path.exists():
+        return None
+
+    # Opened by whichever thread (re)loads the index, then used by others.
+    con = sqlite3.connect(
+        f"{snapshot_path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False
+    )
+    cur = con.cursor()
+    try:
+        cur.execute("PRAGMA user_version")
+        if cur.fetchone()[0] != SNAPSHOT_FORMAT_VERSION:
+            raise sqlite3.DatabaseError("Snapshot format version mismatch.")
+        cur.execute("SELECT file, sha256 FROM snapshot_sources")
+        if dict(cur.fetchall()) != get_source_checksums(base_urls):
+            raise sqlite3.DatabaseError("Snapshot sources changed.")
+    except sqlite3.DatabaseError:
+        con.close()
+        return None
+
+    # Page the file in through mmap rather than SQLite's own heap cache.
+    cur.execute("PRAGMA mmap_size = 268435456")
+    return con, cur
+
+
+def open_database(snapshot_path=SNAPSHOT_PATH, base_urls=None):
+    """ Open the on-disk snapshot, (re)building it first if out of date.
+
+    `base_urls` ({TOS version: base URL}) gives the versions to build it from,
+    if not `common.TOS_VERSION_BASE_URL_MAP`; eg. to build before switching.
+    """
+    opened = open_snapshot(snapshot_path, base_urls)
+    if opened is None:
+        build_snapshot(snapshot_path, base_urls)
+        opened = open_snapshot(snapshot_path, base_urls)
+    return opened
+
 
 def needle_normalize_escapes(needle):
     " Escape underscore wildcards, convert star wildcards to SQL wildcards. "
     return needle.replace("_", r"\_").replace("*", "%")
 
 
+def path_needle_of(needle):
+    """ Return a path needle without its drive, and its escaped form. """
+    try:
+        path_needle = re.match(common.PATH_WITHOUT_DRIVE_PATTERN, needle).group(1)
+    except AttributeError:
+        path_needle = needle
+    return path_needle, needle_normalize_escapes(path_needle)
+
+
 def look_up(TOS_version, needle, con, cur):
     needle_escaped = needle_normalize_escapes(needle)
 
     if "/" in needle:
-        try:
-            path_needle = re.match(common.PATH_WITHOUT_DRIVE_PATTERN, needle).group(1)
-            path_needle_escaped = needle_normalize_escapes(path_needle)
-        except AttributeError:
-            path_needle = needle
-            path_needle_escaped = needle_escaped
+        path_needle, path_needle_escaped = path_needle_of(needle)
 
         cur.execute(
             r"""
-            SELECT full_path, basename, type, is_compressed, TOS_version
+            SELECT full_path, basename, type, is_compressed, TOS_version, link, field_text
             FROM `paths`
             WHERE (
                 `full_path` = ?
@@ -205,13 +536,14 @@ def look_up(TOS_version, needle, con, cur):
                 OR `full_path` LIKE ? ESCAPE '\'
             )
             AND `TOS_version` = (?)
+            ORDER BY `full_path`, rowid
             """,
             [path_needle, path_needle_escaped, path_needle_escaped+".%", TOS_version]
         )
     else:
         cur.execute(
             r"""
-            SELECT full_path, basename, type, is_compressed, TOS_version
+            SELECT full_path, basename, type, is_compressed, TOS_version, link, field_text
             FROM `paths`
             WHERE (
                 `basename` = ?
@@ -219,49 +551,132 @@ def look_up(TOS_version, needle, con, cur):
                 OR `basename` LIKE ? ESCAPE '\'
             )
             AND `TOS_version` = (?)
+            ORDER BY `basename`, rowid
             """,
             [needle, needle_escaped, needle_escaped+".%", TOS_version]
         )
-    tuple_path_matches = cur.fetchall()
-    path_matches = []
-    for m in tuple_path_matches:
-        path_matches.append(
-            {
-                "full_path": m[0],
-                "basename": m[1],
-                "type": m[2],
-                "is_compressed": bool(m[3]),
-                "TOS_version": m[4]
-            }
-        )
+    path_matches = [PathRecord(*m) for m in cur.fetchall()]
 
     cur.execute(
         r"""
-        SELECT name, file, line, type, TOS_version
+        SELECT name, file, line, type, TOS_version, link, field_text
         FROM `symbols` WHERE (
             `name` = ?
             OR `name` LIKE ? ESCAPE '\'
         )
         AND `TOS_version` = (?) 
+        ORDER BY `name`, rowid
         """,
         [needle, needle_escaped, TOS_version]
     )
-    tuple_symbol_matches = cur.fetchall()
-    symbol_matches = []
-    for m in tuple_symbol_matches:
-        symbol_matches.append(
-            {
-                "name": m[0],
-                "file": m[1],
-                "line": m[2],
-                "type": m[3],
-                "TOS_version": m[4]
-            }
-        )
+    symbol_matches = [SymbolRecord(*m) for m in cur.fetchall()]
 
     return path_matches, symbol_matches
 
 
+def look_up_many(TOS_version, needles, con, cur):
+    """ Like `look_up()`, for a batch of needles in one query per table.
+
+    Returns a (path matches, symbol matches) pair for each needle, in order.
+    """
+    cur.execute(
+        """
+        CREATE TEMP TABLE IF NOT EXISTS lookup_needles(
+            idx         INTEGER PRIMARY KEY,
+            is_path     BOOLEAN NOT NULL,
+            is_literal  BOOLEAN NOT NULL,
+            needle      TEXT NOT NULL,
+            pattern     TEXT NOT NULL,
+            key         TEXT NOT NULL,
+            key_pattern TEXT NOT NULL
+        )
+        """
+    )
+    cur.execute("DELETE FROM temp.lookup_needles")
+    rows = []
+    for i, needle in enumerate(needles):
+        if "/" in needle:
+            key, key_pattern = path_needle_of(needle)
+        else:
+            key, key_pattern = needle, needle_normalize_escapes(needle)
+        rows.append(
+            (
+                i,
+                "/" in needle,
+                "*" not in needle and "%" not in needle,
+                needle,
+                needle_normalize_escapes(needle),
+                key,
+                key_pattern
+            )
+        )
+    cur.executemany("INSERT INTO temp.lookup_needles VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    results = [([], []) for _ in needles]
+
+    # Each needle matches on `full_path` or `basename` (its "key" column) by
+    # equality, by "missing extension" (a NOCASE range, so indexes are used:
+    # "/" sorts right after "."), or by LIKE, but only if it has wildcards.
+    # The planner knows nothing about the temp table, so pin the join order
+    # (needles outermost) and which index each part uses.
+    selects = []
+    for column, index, is_path in (
+        ("full_path", "PATH", "n.is_path"),
+        ("basename", "BASENAME", "NOT n.is_path")
+    ):
+        for indexed_by, condition in (
+            (f"INDEXED BY `{index}`", f"p.{column} = n.key"),
+            (
+                f"INDEXED BY `{index}`",
+                f"n.is_literal AND p.{column} >= n.key || '.' AND p.{column} < n.key || '/'"
+            ),
+            (
+                "NOT INDEXED",
+                f"NOT n.is_literal AND (p.{column} LIKE n.key_pattern ESCAPE '\\'"
+                f" OR p.{column} LIKE n.key_pattern || '.%' ESCAPE '\\')"
+            ),
+        ):
+            selects.append(
+                f"""
+                SELECT n.idx, p.{column}, p.rowid, p.full_path, p.basename,
+                    p.type, p.is_compressed, p.TOS_version, p.link, p.field_text
+                FROM temp.lookup_needles AS n
+                CROSS JOIN `paths` AS p {indexed_by}
+                ON {is_path} AND {condition} AND p.TOS_version = (?)
+                """
+            )
+    cur.execute(
+        " UNION ".join(selects) + " ORDER BY 1, 2 COLLATE NOCASE, 3",
+        [TOS_version] * len(selects)
+    )
+    for m in cur.fetchall():
+        results[m[0]][0].append(PathRecord(*m[3:]))
+
+    cur.execute(
+        r"""
+        SELECT n.idx, s.name, s.rowid, s.file, s.line, s.type, s.TOS_version,
+            s.link, s.field_text
+        FROM temp.lookup_needles AS n
+        CROSS JOIN `symbols` AS s INDEXED BY `SYMBOL_NAME`
+            ON s.name = n.needle AND s.TOS_version = (?)
+        UNION
+        SELECT n.idx, s.name, s.rowid, s.file, s.line, s.type, s.TOS_version,
+            s.link, s.field_text
+        FROM temp.lookup_needles AS n
+        CROSS JOIN `symbols` AS s NOT INDEXED ON NOT n.is_literal
+            AND s.name LIKE n.pattern ESCAPE '\' AND s.TOS_version = (?)
+        ORDER BY 1, 2 COLLATE NOCASE, 3
+        """,
+        [TOS_version, TOS_version]
+    )
+    for m in cur.fetchall():
+        results[m[0]][1].append(SymbolRecord(m[1], *m[3:]))
+
+    cur.execute("DELETE FROM temp.lookup_needles")
+    con.commit()
+    return results
+
+
 def get_random_symbol_or_path(TOS_version, con, cur):
     pair = random.choice(
         [
@@ -283,40 +698,27 @@ def get_random_symbol_or_path(TOS_version, con, cur):
 def get_all_symbols(TOS_version, con, cur):
     cur.execute(
         r"""
-        SELECT name, file, line, type FROM `symbols`
+        SELECT name, file, line, type, TOS_version, link, field_text FROM `symbols`
         WHERE `TOS_version` = (?) 
         """,
         [TOS_version]
     )
-    symbols = []
-    for m in cur.fetchall():
-        symbols.append(
-            {
-                "name": m[0],
-                "file": m[1],
-                "line": m[2],
-                "type": m[3],
-            }
-        )
-    return symbols
+    return [SymbolRecord(*m) for m in cur.fetchall()]
 
 
 def get_all_paths(TOS_version, con, cur):
     cur.execute(
         r"""
-        SELECT full_path, basename, type, is_compressed from `paths`
+        SELECT full_path, basename, type, is_compressed, TOS_version, link, field_text
+        FROM `paths`
         WHERE `TOS_version` = (?) 
         """,
         [TOS_version]
     )
-    paths = []
-    for m in cur.fetchall():
-        paths.append(
-            {
-                "full_path": m[0],
-                "basename": m[1],
-                "type": m[2],
-                "is_compressed": bool(m[3]),
-            }
-        )
-    return paths
+    return [PathRecord(*m) for m in cur.fetchall()]
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else SNAPSHOT_PATH
+    build_snapshot(path)
+    print(f"Wrote index snapshot to {path}")
@@ -0,0 +1,236 @@
+""" Golden queries: check every lookup engine against a checked-in corpus.
+
+Run from `src/`:
+
+    python golden.py                  # Check; exit 1 on any mismatch or overrun.
+    python golden.py --update         # Rewrite golden.json from the SQL engine.
+    python golden.py --budget-scale 3 # Allow slower machines three times over.
+
+`golden.json` holds, per TOS version and query class, needles and what they
+must find. Each engine (SQL `data.look_up`, the in-memory index, and whole
+messages through `main.process_msg`) looks every one up, with one database,
+one index and one event loop throughout; any difference is a mismatch. Each
+engine's p90 latency per query class must also stay within its budget,
+times the scale in $GOLDEN_BUDGET_SCALE if set (as `--budget-scale`).
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import pathlib
+import sys
+import time
+
+import bench
+import common
+import data
+import main
+
+CORPUS_PATH = pathlib.Path("golden.json")
+
+# p90 latency allowed, in microseconds, per engine and query class. Several
+# times what they take now; an overrun means something got a lot slower.
+LATENCY_BUDGETS_US = {
+    "sql": {
+        "exact symbol": 2_000,
+        "exact path": 2_000,
+        "no extension": 3_000,
+        "wildcard": 20_000,
+        "not found": 3_000,
+        "upper case": 2_000,
+        "drive path": 2_000,
+    },
+    "index": {
+        "exact symbol": 300,
+        "exact path": 300,
+        "no extension": 500,
+        "wildcard": 3_000,
+        "not found": 3_000,
+        "upper case": 300,
+        "drive path": 300,
+    },
+    "process_msg": {
+        "exact symbol": 3_000,
+        "exact path": 3_000,
+        "no extension": 3_000,
+        "wildcard": 10_000,
+        "not found": 10_000,
+        "upper case": 3_000,
+        "drive path": 3_000,
+    },
+}
+
+# ==============================================================================
+
+def sample_needles(TOS_version, con, cur, count):
+    """ Return {query class: [needle, ...]}; `bench`'s classes and a few more. """
+    needles = bench.sample_needles(TOS_version, con, cur, count)
+    needles["upper case"] = [n.upper() for n in needles["exact symbol"]]
+    needles["drive path"] = [f"c:{n}".lower() for n in needles["exact path"]]
+    return needles
+
+
+def summarize(paths, symbols):
+    """ The parts of a lookup's matches that the corpus pins down. """
+    return {
+        "paths": [p["full_path"] for p in paths],
+        "symbols": [[s["name"], s["file"], s["line"]] for s in symbols],
+    }
+
+
+def message_text(TOS_version, needle):
+    return f"See %%({TOS_version}){needle} here."
+
+
+def embed_digest(embed):
+    """ A short hash of an embed's fields, names and text. """
+    fields = [[f.name, f.value] for f in embed.fields] if embed is not None else None
+    return hashlib.sha1(json.dumps(fields).encode("utf-8")).hexdigest()[:16]
+
+
+def build_corpus(con, cur, count):
+    """ Sample needles and record what they find now, as the new golden corpus. """
+    corpus = {}
+    for TOS_version in common.TOS_VERSIONS:
+        corpus[TOS_version] = {}
+        for query_class, needles in sample_needles(TOS_version, con, cur, count).items():
+            cases = corpus[TOS_version][query_class] = []
+            for needle in dict.fromkeys(needles):
+                cases.append({
+                    "needle": needle,
+                    **summarize(*data.look_up(TOS_version, needle, con, cur))
+                })
+
+    async def digest_all():
+        for TOS_version, classes in corpus.items():
+            for cases in classes.values():
+                for case in cases:
+                    embed = await main.process_msg(message_text(TOS_version, case["needle"]))
+                    case["embed"] = embed_digest(embed)
+    asyncio.run(digest_all())
+    return corpus
+
+
+def load_corpus(path=CORPUS_PATH):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_corpus(corpus, path=CORPUS_PATH):
+    """ Write `corpus` as JSON, a case per line so changes diff readably. """
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("{")
+        for i, (TOS_version, classes) in enumerate(corpus.items()):
+            f.write(("," if i else "") + f"\n {json.dumps(TOS_version)}: {{")
+            for j, (query_class, cases) in enumerate(classes.items()):
+                f.write(("," if j else "") + f"\n  {json.dumps(query_class)}: [\n   ")
+                f.write(",\n   ".join(json.dumps(case) for case in cases))
+                f.write("\n  ]")
+            f.write("\n }")
+        f.write("\n}\n")
+
+
+def cases_of(corpus):
+    """ Yield (TOS version, query class, case) for every case in the corpus. """
+    for TOS_version, classes in corpus.items():
+        for query_class, cases in classes.items():
+            for case in cases:
+                yield TOS_version, query_class, case
+
+# Engines ======================================================================
+
+def lookup_engines(con, cur, lookup_index):
+    """ Name -> `fn(TOS version, needle)` returning (paths, symbols).
+
+    Add an alternative engine here and every check covers it.
+    """
+    return {
+        "sql": lambda TOS_version, needle: data.look_up(TOS_version, needle, con, cur),
+        "index": lookup_index.look_up,
+    }
+
+
+def check_engines(corpus, engines):
+    """ Look every case up with every engine.
+
+    Return the mismatches, as (engine, TOS version, query class, needle), and
+    {(engine, query class): [latency in seconds, ...]}.
+    """
+    mismatches = []
+    latencies = {}
+    for name, look_up in engines.items():
+        for TOS_version, query_class, case in cases_of(corpus):
+            start = time.perf_counter()
+            matches = look_up(TOS_version, case["needle"])
+            latencies.setdefault((name, query_class), []).append(time.perf_counter() - start)
+            expected = {"paths": case["paths"], "symbols": case["symbols"]}
+            if summarize(*matches) != expected:
+                mismatches.append((name, TOS_version, query_class, case["needle"]))
+    return mismatches, latencies
+
+
+async def check_messages(corpus):
+    """ As `check_engines()`, for whole messages through `main.process_msg()`. """
+    mismatches = []
+    latencies = {}
+    main.field_cache.clear()
+    # Not-found embeds include suggestions; have them ready, as they'd be.
+    for TOS_version in corpus:
+        main.lookup_index.version_index(TOS_version).build_suggestions()
+    for TOS_version, query_class, case in cases_of(corpus):
+        start = time.perf_counter()
+        embed = await main.process_msg(message_text(TOS_version, case["needle"]))
+        latencies.setdefault(("process_msg", query_class), []).append(time.perf_counter() - start)
+        if embed_digest(embed) != case["embed"]:
+            mismatches.append(("process_msg", TOS_version, query_class, case["needle"]))
+    return mismatches, latencies
+
+
+def budget_scale(default=1):
+    """ The budget multiplier from $GOLDEN_BUDGET_SCALE, else `default`. """
+    return float(os.environ.get("GOLDEN_BUDGET_SCALE", default))
+
+
+def over_budget(latencies, budgets=LATENCY_BUDGETS_US, scale=1):
+    """ Return (engine, query class, p90 us, budget us) for each overrun. """
+    overruns = []
+    for (engine, query_class), values in latencies.items():
+        budget = budgets.get(engine, {}).get(query_class)
+        if budget is None:
+            continue
+        p90 = bench.percentile(sorted(values), 90) * 1e6
+        if p90 > budget * scale:
+            overruns.append((engine, query_class, p90, budget * scale))
+    return overruns
+
+
+def check(corpus, con, cur, lookup_index):
+    """ Check every engine against `corpus`; return (mismatches, latencies). """
+    mismatches, latencies = check_engines(corpus, lookup_engines(con, cur, lookup_index))
+    message_mismatches, message_latencies = asyncio.run(check_messages(corpus))
+    return mismatches + message_mismatches, {**latencies, **message_latencies}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--update", action="store_true", help="rewrite the corpus")
+    parser.add_argument("--count", type=int, default=40, help="needles per query class (--update)")
+    parser.add_argument("--budget-scale", type=float, default=budget_scale(), help="multiply every budget")
+    args = parser.parse_args()
+
+    if args.update:
+        write_corpus(build_corpus(main.db_con, main.db_cur, args.count))
+        print(f"Wrote {sum(1 for _ in cases_of(load_corpus()))} cases to {CORPUS_PATH}.")
+        sys.exit(0)
+
+    mismatches, latencies = check(load_corpus(), main.db_con, main.db_cur, main.lookup_index)
+    for (engine, query_class), values in sorted(latencies.items()):
+        bench.report(f"{engine} {query_class}", values)
+    for engine, TOS_version, query_class, needle in mismatches:
+        print(f"MISMATCH {engine}: ({TOS_version}) {needle!r} [{query_class}]")
+    overruns = over_budget(latencies, scale=args.budget_scale)
+    for engine, query_class, p90, budget in overruns:
+        print(f"OVER BUDGET {engine} {query_class}: p90 {p90:.0f}us > {budget:.0f}us")
+    sys.exit(1 if mismatches or overruns else 0)
@@ -0,0 +1,899 @@
+""" In-process lookup index over the `paths` and `symbols` tables.
+
+Answers the same queries as `data.look_up()`, with the same results, without
+a SQL round trip per needle.
+"""
+
+import array
+import bisect
+import collections
+import collections.abc
+import heapq
+import re
+import string
+import threading
+import time
+
+import common
+import data
+
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+NGRAM_LEN = 3
+
+MAX_SUGGESTIONS = 3
+MAX_SUGGESTION_CANDIDATES = 200
+MIN_SUGGESTION_NEEDLE_LEN = 3
+# A lookup spends at most this long on suggestions, then goes without.
+SUGGESTION_TIME_LIMIT_SECONDS = 0.005
+
+# Discord shows at most 25 autocomplete choices. Prefixes matching more than
+# COMPLETION_SCAN_LIMIT keys have their top choices worked out in advance.
+MAX_COMPLETIONS = 25
+COMPLETION_SCAN_LIMIT = 256
+
+# A path the trie can walk: "/" or "/a/b...", no empty parts.
+TRIE_PATH_PATTERN = re.compile(r"^(?:/|(?:/[^/]+)+)$")
+
+# subdirectories: [(record, file count)]; type_counts: {type: files} under it all.
+DirectoryListing = collections.namedtuple(
+    "DirectoryListing", ["directory", "subdirectories", "files", "type_counts"]
+)
+
+# =============================================================================
+
+def fold(s):
+    """ Case-fold like SQLite's NOCASE and LIKE do: ASCII letters only. """
+    return s.translate(ASCII_LOWER)
+
+
+def needle_key(needle):
+    """ A key shared by exactly those needles that `look_up()` treats alike.
+
+    Matching is case-insensitive, but whether a drive prefix gets stripped
+    from a path needle is not, so that part of the needle is kept apart.
+    """
+    if "/" in needle:
+        return fold(needle), fold(data.path_needle_of(needle)[0])
+    return fold(needle)
+
+
+def like_parse(pattern):
+    """ Split a LIKE pattern into literal runs; odd items are `%`/`_` wildcards. """
+    tokens = []
+    run = []
+    chars = iter(pattern)
+    for c in chars:
+        if c == "\\":
+            run.append(next(chars, ""))
+        elif c in "%_":
+            tokens += ["".join(run), c]
+            run = []
+        else:
+            run.append(c)
+    tokens.append("".join(run))
+    return tokens
+
+
+def like_to_regex(tokens):
+    parts = []
+    for i, token in enumerate(tokens):
+        if i % 2 == 0:
+            parts.append(re.escape(token))
+        else:
+            parts.append(".*" if token == "%" else ".")
+    return re.compile("".join(parts), re.DOTALL)
+
+
+def ngrams(s):
+    return {s[i:i+NGRAM_LEN] for i in range(len(s) - NGRAM_LEN + 1)}
+
+
+def single_deletes(s):
+    """ `s` and every string made by deleting one character from it. """
+    return {s} | {s[:i] + s[i+1:] for i in range(len(s))}
+
+
+def edit_distance(a, b):
+    """ Optimal string alignment distance (Levenshtein plus transpositions). """
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(
+                previous[j] + 1,
+                current[j-1] + 1,
+                previous[j-1] + (a[i-1] != b[j-1])
+            )
+            if i > 1 and j > 1 and a[i-1] == b[j-2] and a[i-2] == b[j-1]:
+                current[j] = min(current[j], previous2[j-2] + 1)
+        previous2, previous = previous, current
+    return previous[-1]
+
+# =============================================================================
+
+class KeyIndex:
+    """ Maps folded keys to row ids.
+
+    A sorted key array answers prefix matches, and a trigram index narrows
+    wildcard matches down to candidates before they are checked.
+    """
+
+    def __init__(self, keys):
+        ids_by_key = {}
+        for row_id, key in enumerate(keys):
+            ids_by_key.setdefault(fold(key), []).append(row_id)
+        # Tuples, and one string object per key, keep the index small.
+        self.ids_by_key = {key: tuple(ids) for key, ids in ids_by_key.items()}
+        self.key_by_id = [None] * sum(len(ids) for ids in ids_by_key.values())
+        for key, ids in ids_by_key.items():
+            for row_id in ids:
+                self.key_by_id[row_id] = key
+        self.sorted_keys = sorted(self.ids_by_key)
+
+        keys_by_ngram = {}
+        for key in self.sorted_keys:
+            for ngram in ngrams(key):
+                keys_by_ngram.setdefault(ngram, []).append(key)
+        self.keys_by_ngram = {ngram: tuple(keys) for ngram, keys in keys_by_ngram.items()}
+
+    def exact(self, key):
+        return self.ids_by_key.get(fold(key), ())
+
+    def prefixed_keys(self, prefix):
+        i = bisect.bisect_left(self.sorted_keys, prefix)
+        while i < len(self.sorted_keys) and self.sorted_keys[i].startswith(prefix):
+            yield self.sorted_keys[i]
+            i += 1
+
+    def prefixed(self, prefix):
+        for key in self.prefixed_keys(fold(prefix)):
+            yield from self.ids_by_key[key]
+
+    def like_candidates(self, tokens):
+        """ Keys containing every trigram of the pattern's literal runs. """
+        needed = set()
+        for run in tokens[::2]:
+            needed |= ngrams(run)
+        if not needed:
+            # Too short for trigrams, but a leading literal is still a prefix.
+            return self.prefixed_keys(tokens[0]) if tokens[0] else self.sorted_keys
+
+        postings = []
+        for ngram in needed:
+            keys = self.keys_by_ngram.get(ngram)
+            if keys is None:
+                return []
+            postings.append(keys)
+        postings.sort(key=len)
+
+        candidates = set(postings[0])
+        for keys in postings[1:]:
+            candidates.intersection_update(keys)
+            if not candidates:
+                break
+        return candidates
+
+    def like(self, tokens, extension_wildcard=False):
+        regexes = [like_to_regex(tokens)]
+        if extension_wildcard:
+            regexes.append(like_to_regex(tokens[:-1] + [tokens[-1] + ".", "%", ""]))
+
+        # Every `pattern.%` match also matches `pattern`'s literal runs.
+        for key in self.like_candidates(tokens):
+            if any(regex.fullmatch(key) for regex in regexes):
+                yield from self.ids_by_key[key]
+
+    def equal_or_like(self, value, pattern, extension_wildcard=False):
+        """ Row ids where `key = value OR key LIKE pattern [OR key LIKE pattern.%]`. """
+        ids = set(self.exact(value))
+        tokens = like_parse(fold(pattern))
+        if len(tokens) == 1:
+            ids.update(self.exact(tokens[0]))
+            if extension_wildcard:
+                ids.update(self.prefixed(tokens[0] + "."))
+        else:
+            ids.update(self.like(tokens, extension_wildcard))
+
+        # Same order as `data.look_up()`: by key, then by row.
+        return sorted(ids, key=lambda i: (self.key_by_id[i], i))
+
+    def explain(self, pattern):
+        """ How `equal_or_like()` would match `pattern`, and over how many keys. """
+        tokens = like_parse(fold(pattern))
+        if len(tokens) == 1:
+            return {"method": "exact"}
+        return {"method": "like", "candidates": sum(1 for _ in self.like_candidates(tokens))}
+
+
+class PathNode:
+    __slots__ = ("children", "path_ids", "type_counts")
+
+    def __init__(self):
+        self.children = {}
+        self.path_ids = ()
+        # Directories only: {type: count} of every file beneath.
+        self.type_counts = None
+
+
+class PathTrie:
+    """ The directory tree of a version's paths, one node per path part.
+
+    Exact and "missing extension" lookups walk one node per part, and each
+    directory's file counts by type are summed once, when built.
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.root = PathNode()
+        for row_id, path in enumerate(paths):
+            node = self.root
+            for part in self.parts(path["full_path"]):
+                child = node.children.get(part)
+                if child is None:
+                    child = node.children[part] = PathNode()
+                node = child
+            node.path_ids += (row_id,)
+        self.count_files(self.root)
+
+    @staticmethod
+    def parts(full_path):
+        return [] if full_path == "/" else fold(full_path).split("/")[1:]
+
+    def is_directory(self, node):
+        return node.children != {} or any(
+            self.paths[i]["type"] == "Directory" for i in node.path_ids
+        )
+
+    def count_files(self, node):
+        type_counts = collections.Counter()
+        for child in node.children.values():
+            if self.is_directory(child):
+                type_counts.update(self.count_files(child))
+            else:
+                type_counts.update(self.paths[i]["type"] for i in child.path_ids)
+        node.type_counts = dict(type_counts)
+        return type_counts
+
+    def find(self, full_path):
+        node = self.root
+        for part in self.parts(full_path):
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node
+
+    def subtree_ids(self, node):
+        yield from node.path_ids
+        for child in node.children.values():
+            yield from self.subtree_ids(child)
+
+    def exact_or_extension(self, full_path):
+        """ Row ids where `full_path = path OR full_path LIKE path.%`, any order. """
+        parent_path, _, name = fold(full_path).rpartition("/")
+        parent = self.find(parent_path or "/")
+        if parent is None:
+            return []
+        # No part is empty, so for "/" (name "") only "/.%" can match below.
+        ids = list(self.root.path_ids) if full_path == "/" else []
+        for key, child in parent.children.items():
+            if key == name:
+                ids += child.path_ids
+            elif key.startswith(name + "."):
+                ids += self.subtree_ids(child)
+        return ids
+
+    def list_directory(self, full_path):
+        """ A `DirectoryListing` of a directory; None if there's no such directory. """
+        node = self.find(full_path)
+        if node is None or node.path_ids == () or not self.is_directory(node):
+            return None
+        subdirectories = []
+        files = []
+        for child in node.children.values():
+            for i in child.path_ids:
+                if self.is_directory(child):
+                    subdirectories.append((self.paths[i], sum(child.type_counts.values())))
+                else:
+                    files.append(self.paths[i])
+        subdirectories.sort(key=lambda d: fold(d[0]["basename"]))
+        files.sort(key=lambda f: fold(f["basename"]))
+        return DirectoryListing(
+            self.paths[node.path_ids[0]], subdirectories, files, node.type_counts
+        )
+
+
+class SuggestionIndex:
+    """ SymSpell-style single-deletion index for "did you mean" suggestions.
+
+    Two words one typo apart (insertion, deletion, substitution or adjacent
+    transposition) always share a single-character deletion, so a query
+    costs one dict probe per character of the needle, never a scan.
+    """
+
+    def __init__(self, names):
+        self.name_by_key = {}
+        for name in names:
+            self.name_by_key.setdefault(fold(name), name)
+
+        # Deletions are stored by hash only: a collision just adds a candidate
+        # that the edit distance check then rejects. Most deletions belong to
+        # a single key, which is then stored bare rather than in a tuple.
+        keys_by_delete = {}
+        for key in self.name_by_key:
+            for delete in single_deletes(key):
+                keys_by_delete.setdefault(hash(delete), []).append(key)
+        self.keys_by_delete = {
+            h: keys[0] if len(keys) == 1 else tuple(keys)
+            for h, keys in keys_by_delete.items()
+        }
+
+    def suggest(self, needle, limit=MAX_SUGGESTIONS, deadline=None):
+        """ Return near misses; None if `time.monotonic()` passes `deadline` first. """
+        needle = fold(needle)
+        if len(needle) < MIN_SUGGESTION_NEEDLE_LEN:
+            return []
+
+        candidates = set()
+        for delete in single_deletes(needle):
+            keys = self.keys_by_delete.get(hash(delete), ())
+            if isinstance(keys, str):
+                candidates.add(keys)
+            else:
+                candidates.update(keys)
+            if len(candidates) >= MAX_SUGGESTION_CANDIDATES:
+                break
+        candidates.discard(needle)
+
+        ranked = []
+        for key in candidates:
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            ranked.append((edit_distance(needle, key), len(key), key))
+        ranked.sort()
+        return [self.name_by_key[key] for _, _, key in ranked[:limit]]
+
+
+def completion_rank(symbol_type):
+    if symbol_type == "Funct Public":
+        return 0
+    if "Public" in (symbol_type or "").split():
+        return 1
+    return 2
+
+
+class CompletionIndex:
+    """ Ranked prefix completion, for autocomplete.
+
+    `entries` are (text, rank) pairs; a lower rank comes first, then shorter
+    text. Keys are kept sorted, so a prefix's matches are one contiguous run.
+    Short runs are ranked as they're asked for; each longer one (there are
+    few) has its top `MAX_COMPLETIONS` stored when the index is built.
+    """
+
+    def __init__(self, entries):
+        best = {}
+        for text, rank in entries:
+            order = (rank, len(text), fold(text), text)
+            if text not in best or order < best[text]:
+                best[text] = order
+        ordered = sorted(best.values(), key=lambda o: (o[2], o))
+        self.keys = [o[2] for o in ordered]
+        self.orders = ordered
+
+        self.top_by_prefix = {}
+        if self.keys:
+            self.store_top(0, len(self.keys), 0)
+
+    def top(self, lo, hi, limit=MAX_COMPLETIONS):
+        return tuple(o[3] for o in heapq.nsmallest(limit, self.orders[lo:hi]))
+
+    def store_top(self, lo, hi, depth):
+        """ Store the top of keys[lo:hi], which share their first `depth`
+        characters, then of each longer prefix's run that's still too long.
+        """
+        prefix = self.keys[lo][:depth]
+        self.top_by_prefix[prefix] = self.top(lo, hi)
+        i = lo
+        while i < hi and len(self.keys[i]) == depth:
+            i += 1
+        while i < hi:
+            next_prefix = self.keys[i][:depth + 1]
+            j = bisect.bisect_left(self.keys, next_prefix[:-1] + chr(ord(next_prefix[-1]) + 1), i, hi)
+            if j - i > COMPLETION_SCAN_LIMIT:
+                self.store_top(i, j, depth + 1)
+            i = j
+
+    def complete(self, prefix, limit=MAX_COMPLETIONS):
+        prefix = fold(prefix)
+        top = self.top_by_prefix.get(prefix)
+        if top is not None:
+            return list(top[:limit])
+        lo = bisect.bisect_left(self.keys, prefix)
+        hi = bisect.bisect_left(self.keys, prefix + "\U0010ffff", lo)
+        return list(self.top(lo, hi, limit))
+
+
+class VersionIndex:
+    """ All paths and symbols of one TOS version, in table (rowid) order. """
+
+    def __init__(self, TOS_version, paths, symbols):
+        self.TOS_version = TOS_version
+        self.paths = paths
+        self.symbols = symbols
+        self.full_paths = KeyIndex(p["full_path"] for p in paths)
+        self.basenames = KeyIndex(p["basename"] for p in paths)
+        self.symbol_names = KeyIndex(s["name"] for s in symbols)
+        self.path_trie = PathTrie(paths)
+        self.suggestions = None
+        self.suggestions_lock = threading.Lock()
+        self.name_completions = None
+        self.path_completions = None
+
+    def build_suggestions(self):
+        """ Build the index `suggest()` uses, if it isn't already. Slow (about
+        0.1s per version, more at scale), so never done on the lookup path.
+        """
+        with self.suggestions_lock:
+            if self.suggestions is None:
+                self.suggestions = SuggestionIndex(
+                    [s["name"] for s in self.symbols]
+                    + [p["basename"].split(".")[0] for p in self.paths if p["basename"] != "/"]
+                )
+
+    def suggest(self, needle):
+        """ Symbol names and basenames (sans extensions) one typo from `needle`.
+
+        None when there's no saying in time: the suggestion index is still
+        building (the first call starts that, in the background), or
+        `SUGGESTION_TIME_LIMIT_SECONDS` ran out.
+        """
+        if "*" in needle:
+            return []
+        if self.suggestions is None:
+            if not self.suggestions_lock.locked():
+                threading.Thread(
+                    target=self.build_suggestions, name="suggestions", daemon=True
+                ).start()
+            return None
+        return self.suggestions.suggest(
+            needle.rsplit("/", 1)[-1].split(".")[0],
+            deadline=time.monotonic() + SUGGESTION_TIME_LIMIT_SECONDS
+        )
+
+    def complete(self, prefix, limit=MAX_COMPLETIONS):
+        """ Up to `limit` symbol names and basenames starting with `prefix`; or
+        full paths, if it has a "/" (directories end in one, to list them).
+
+        Public functions come first, then other public symbols, then the rest;
+        shorter before longer within each.
+        """
+        if "/" in prefix:
+            if self.path_completions is None:
+                self.path_completions = CompletionIndex(
+                    (p["full_path"] + "/" if p["type"] == "Directory" else p["full_path"], 0)
+                    for p in self.paths if p["full_path"] != "/"
+                )
+            return self.path_completions.complete(data.path_needle_of(prefix)[0], limit)
+
+        if self.name_completions is None:
+            self.name_completions = CompletionIndex(
+                [(s["name"], completion_rank(s["type"])) for s in self.symbols]
+                + [(p["basename"], 2) for p in self.paths if p["type"] != "Directory"]
+            )
+        return self.name_completions.complete(prefix, limit)
+
+    def list_directory(self, needle):
+        """ List the directory a needle like "/Demo/" or "C:/Demo/" names; None if none. """
+        path_needle = data.path_needle_of(needle)[0]
+        if len(path_needle) < 2 or not path_needle.endswith("/"):
+            return None
+        return self.path_trie.list_directory(path_needle[:-1])
+
+    def look_up(self, needle):
+        needle_escaped = data.needle_normalize_escapes(needle)
+
+        if "/" in needle:
+            path_needle, path_needle_escaped = data.path_needle_of(needle)
+            if "*" in path_needle or "%" in path_needle or not TRIE_PATH_PATTERN.match(path_needle):
+                path_ids = self.full_paths.equal_or_like(
+                    path_needle, path_needle_escaped, extension_wildcard=True
+                )
+            else:
+                path_ids = sorted(
+                    self.path_trie.exact_or_extension(path_needle),
+                    key=lambda i: (self.full_paths.key_by_id[i], i)
+                )
+        else:
+            path_ids = self.basenames.equal_or_like(
+                needle, needle_escaped, extension_wildcard=True
+            )
+
+        symbol_ids = self.symbol_names.equal_or_like(needle, needle_escaped)
+
+        return (
+            [self.paths[i] for i in path_ids],
+            [self.symbols[i] for i in symbol_ids]
+        )
+
+    def explain(self, needle):
+        """ The plan `look_up()` follows for a needle, eg. for logging slow ones. """
+        needle_escaped = data.needle_normalize_escapes(needle)
+        if "/" in needle:
+            path_needle, path_needle_escaped = data.path_needle_of(needle)
+            if "*" in path_needle or "%" in path_needle or not TRIE_PATH_PATTERN.match(path_needle):
+                paths = {"key": "full_path", **self.full_paths.explain(path_needle_escaped)}
+            else:
+                paths = {"key": "full_path", "method": "trie"}
+        else:
+            paths = {"key": "basename", **self.basenames.explain(needle_escaped)}
+        return {"paths": paths, "symbols": self.symbol_names.explain(needle_escaped)}
+
+
+# Shared records ===============================================================
+
+# A symbol line table's entry for a symbol with no line.
+NO_LINE = -1
+
+
+class RecordStore:
+    """ The paths and symbols of every TOS version loaded, each distinct one
+    stored once, with a bitmap of the versions that have it (bit i is set for
+    `TOS_versions[i]`).
+
+    Paths are the same if their full path is, symbols if their name, file and
+    type are; a symbol's line can differ, so each version has a line table.
+    Versions read them through `StoredPath`s and `StoredSymbol`s, which add
+    what's particular to a version (its link and field text, on first use).
+    """
+
+    def __init__(self, TOS_versions, base_urls):
+        self.TOS_versions = TOS_versions
+        self.base_urls = base_urls
+        # Records without version, link or field text; and their bitmaps.
+        self.paths = []
+        self.path_versions = []
+        self.symbols = []
+        self.symbol_versions = []
+        # Per version: each symbol's line there, by id; `NO_LINE` for None.
+        self.symbol_lines = [array.array("i") for _ in TOS_versions]
+        # Ids of symbols listed again within one version (after the first).
+        self.symbol_repeats = set()
+        self.path_ids = {}
+        self.symbol_ids = {}
+        # TOS version -> (path ids, symbol ids), in its table order.
+        self.version_ids = {}
+
+    def add_version(self, TOS_version, paths, symbols):
+        """ Store a version's records; return its (path ids, symbol ids). """
+        ids = self.version_ids.get(TOS_version)
+        if ids is not None:
+            return ids
+        bit = self.TOS_versions.index(TOS_version)
+
+        path_ids = array.array("i")
+        for p in paths:
+            i = self.path_ids.get(p.full_path)
+            if i is None:
+                i = self.path_ids[p.full_path] = len(self.paths)
+                self.paths.append(p)
+                self.path_versions.append(0)
+            self.path_versions[i] |= 1 << bit
+            path_ids.append(i)
+
+        symbol_ids = array.array("i")
+        lines = self.symbol_lines[bit]
+        occurrences = collections.Counter()
+        for s in symbols:
+            # A version listing a symbol twice has two; the second is shared
+            # with other versions' second, if any.
+            same_symbol = (s.name, s.file_code, s.type_code)
+            key = (*same_symbol, occurrences[same_symbol])
+            occurrences[same_symbol] += 1
+            i = self.symbol_ids.get(key)
+            if i is None:
+                i = self.symbol_ids[key] = len(self.symbols)
+                self.symbols.append(s)
+                self.symbol_versions.append(0)
+                if key[3] > 0:
+                    self.symbol_repeats.add(i)
+            self.symbol_versions[i] |= 1 << bit
+            if len(lines) <= i:
+                lines.extend([NO_LINE] * (i + 1 - len(lines)))
+            lines[i] = NO_LINE if s.line is None else s.line
+            symbol_ids.append(i)
+
+        self.version_ids[TOS_version] = path_ids, symbol_ids
+        return path_ids, symbol_ids
+
+    def all_ids(self):
+        """ (path ids, symbol ids) of every version added, each once, in order
+        of first appearance; a symbol listed twice in a version, once.
+        """
+        ids = []
+        for kind in range(2):
+            seen = set()
+            kind_ids = array.array("i")
+            for TOS_version in self.TOS_versions:
+                for i in self.version_ids.get(TOS_version, ((), ()))[kind]:
+                    if i not in seen and not (kind == 1 and i in self.symbol_repeats):
+                        seen.add(i)
+                        kind_ids.append(i)
+            ids.append(kind_ids)
+        return tuple(ids)
+
+    def versions_of(self, bitmap):
+        return [v for bit, v in enumerate(self.TOS_versions) if bitmap >> bit & 1]
+
+    def symbol_line(self, i, TOS_version):
+        """ A symbol's line in a version; None for all versions: the first's. """
+        if TOS_version is None:
+            TOS_version = self.versions_of(self.symbol_versions[i])[0]
+        line = self.symbol_lines[self.TOS_versions.index(TOS_version)][i]
+        return None if line == NO_LINE else line
+
+
+class StoredRecord(data.Record):
+    """ One of a `RecordStore`'s records as a version has it; made as it's read.
+
+    `TOS_version` None stands for every version that has it (they're all in
+    its field text); its line is then the first one's. `link` and `field_text`
+    are rendered when first read; the other fields are the stored record's.
+    """
+
+    __slots__ = ("store", "id", "TOS_version")
+
+    def __init__(self, store, id, TOS_version):
+        self.store = store
+        self.id = id
+        self.TOS_version = TOS_version
+
+    def __getattr__(self, name):
+        # Reached for unset slots (`link`, `field_text`) and stored fields only.
+        if name in data.Record.DERIVED_FIELDS:
+            self.link = None
+            self.render()
+            return getattr(self, name)
+        return getattr(self.stored(), name)
+
+    @property
+    def versions(self):
+        """ The versions that have this record, in `store.TOS_versions` order. """
+        return self.store.versions_of(self.bitmap())
+
+
+class StoredPath(StoredRecord):
+    __slots__ = ()
+    FIELDS = data.PathRecord.FIELDS
+
+    def stored(self):
+        return self.store.paths[self.id]
+
+    def bitmap(self):
+        return self.store.path_versions[self.id]
+
+    def render(self):
+        if self.TOS_version is None:
+            data.render_cross_version_path(self, self.versions, self.store.base_urls)
+        else:
+            data.render_path(self, self.store.base_urls)
+
+
+class StoredSymbol(StoredRecord):
+    __slots__ = ()
+    FIELDS = data.SymbolRecord.FIELDS
+
+    def stored(self):
+        return self.store.symbols[self.id]
+
+    def bitmap(self):
+        return self.store.symbol_versions[self.id]
+
+    @property
+    def line(self):
+        return self.store.symbol_line(self.id, self.TOS_version)
+
+    def render(self):
+        if self.TOS_version is None:
+            lines = [(v, self.store.symbol_line(self.id, v)) for v in self.versions]
+            data.render_cross_version_symbol(self, lines, self.store.base_urls)
+        else:
+            data.render_symbol(self, self.store.base_urls)
+
+
+class StoredRecords(collections.abc.Sequence):
+    """ A version's paths or symbols, in table order, read from a `RecordStore`. """
+
+    def __init__(self, record_type, store, ids, TOS_version):
+        self.record_type = record_type
+        self.store = store
+        self.ids = ids
+        self.TOS_version = TOS_version
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return self.record_type(self.store, self.ids[i], self.TOS_version)
+
+    def __iter__(self):
+        for i in self.ids:
+            yield self.record_type(self.store, i, self.TOS_version)
+
+# =============================================================================
+
+class Index:
+    """ Lookup index over a database connection.
+
+    Each TOS version's part is built the first time it's used, and can be
+    dropped again once it has sat idle.
+
+    Versions are built on whichever thread first needs them, so the index
+    needs a connection of its own: nothing else may use `con` or `cur`, and
+    the index uses them only under `lock`.
+
+    Records are kept in one `RecordStore`, shared by every version that has
+    them (and by `common.ALL_TOS_VERSIONS`); dropping a version drops only
+    its own indexes over them.
+
+    `base_urls` ({TOS version: base URL}) are those the database was built
+    with, if not `common.TOS_VERSION_BASE_URL_MAP`'s.
+    """
+
+    def __init__(self, con, cur, base_urls=None):
+        self.con = con
+        self.cur = cur
+        if base_urls is None:
+            base_urls = common.TOS_VERSION_BASE_URL_MAP
+        self.base_urls = dict(base_urls)
+        self.lock = threading.Lock()
+        self.versions = {}
+        self.last_used = {}
+
+        cur.execute(
+            "SELECT TOS_version FROM `paths` UNION SELECT TOS_version FROM `symbols`"
+        )
+        self.known_versions = {fold(m[0]): m[0] for m in cur.fetchall()}
+        self.known_versions_or_all = {
+            **self.known_versions, common.ALL_TOS_VERSIONS: common.ALL_TOS_VERSIONS
+        }
+        self.store = RecordStore(sorted(self.known_versions.values()), self.base_urls)
+
+    def reconnect(self, con, cur):
+        """ Load versions through another connection from now on, eg. after a fork. """
+        with self.lock:
+            self.con = con
+            self.cur = cur
+
+    def fetch_records(self, TOS_version):
+        """ Read a version's records, less what `StoredRecord`s add; call with
+        `self.lock` held.
+        """
+        self.cur.execute(
+            """
+            SELECT full_path, basename, type, is_compressed
+            FROM `paths` WHERE `TOS_version` = (?) ORDER BY rowid
+            """,
+            [TOS_version]
+        )
+        paths = [data.PathRecord(*m) for m in self.cur.fetchall()]
+
+        self.cur.execute(
+            """
+            SELECT name, file, line, type
+            FROM `symbols` WHERE `TOS_version` = (?) ORDER BY rowid
+            """,
+            [TOS_version]
+        )
+        symbols = [data.SymbolRecord(*m) for m in self.cur.fetchall()]
+
+        return paths, symbols
+
+    def store_version(self, TOS_version):
+        """ Add a version's records to the store, if they aren't; return their
+        ids (see `RecordStore.add_version()`). Call with `self.lock` held.
+        """
+        ids = self.store.version_ids.get(TOS_version)
+        if ids is None:
+            ids = self.store.add_version(TOS_version, *self.fetch_records(TOS_version))
+        return ids
+
+    def load_version(self, TOS_version):
+        if TOS_version == common.ALL_TOS_VERSIONS:
+            for v in self.store.TOS_versions:
+                self.store_version(v)
+            path_ids, symbol_ids = self.store.all_ids()
+            records_version = None
+        else:
+            path_ids, symbol_ids = self.store_version(TOS_version)
+            records_version = TOS_version
+        return VersionIndex(
+            TOS_version,
+            StoredRecords(StoredPath, self.store, path_ids, records_version),
+            StoredRecords(StoredSymbol, self.store, symbol_ids, records_version)
+        )
+
+    def version_index(self, TOS_version):
+        """ Return a version's index, building it if needed; None if unknown.
+
+        `common.ALL_TOS_VERSIONS` gets one over every version's records, each
+        once, reading as from every version that has it (see `StoredRecord`).
+        """
+        key = fold(TOS_version)
+        version_index = self.versions.get(key)
+        if version_index is None:
+            if key not in self.known_versions_or_all:
+                return None
+            with self.lock:
+                version_index = self.versions.get(key)
+                if version_index is None:
+                    version_index = self.load_version(self.known_versions_or_all[key])
+                    self.versions[key] = version_index
+        self.last_used[key] = time.monotonic()
+        return version_index
+
+    def loaded_versions(self):
+        return [v.TOS_version for v in list(self.versions.values())]
+
+    def evict_idle(self, max_idle_seconds):
+        """ Drop versions unused for `max_idle_seconds`; return their names. """
+        evicted = []
+        with self.lock:
+            for key in list(self.versions):
+                if time.monotonic() - self.last_used.get(key, 0) > max_idle_seconds:
+                    evicted.append(self.versions.pop(key).TOS_version)
+        return evicted
+
+    def look_up(self, TOS_version, needle):
+        """ Same results as `data.look_up()`, as `StoredRecord`s. """
+        version_index = self.version_index(TOS_version)
+        if version_index is None:
+            return [], []
+        return version_index.look_up(needle)
+
+    def is_loaded(self, TOS_version):
+        """ Whether a version's index is built (so its next lookup won't build it). """
+        return fold(TOS_version) in self.versions
+
+    def explain(self, TOS_version, needle):
+        """ `VersionIndex.explain()`; {} if the version isn't loaded (explaining
+        never builds one).
+        """
+        version_index = self.versions.get(fold(TOS_version))
+        if version_index is None:
+            return {}
+        return version_index.explain(needle)
+
+    def look_up_many(self, TOS_version, needles):
+        """ `look_up()` for each needle, in order; equivalent needles resolve once. """
+        version_index = self.version_index(TOS_version)
+        if version_index is None:
+            return [([], []) for _ in needles]
+
+        results_by_key = {}
+        for needle in needles:
+            key = needle_key(needle)
+            if key not in results_by_key:
+                results_by_key[key] = version_index.look_up(needle)
+        return [results_by_key[needle_key(needle)] for needle in needles]
+
+    def complete(self, TOS_version, prefix, limit=MAX_COMPLETIONS):
+        version_index = self.version_index(TOS_version)
+        if version_index is None:
+            return []
+        return version_index.complete(prefix, limit)
+
+    def list_directory(self, TOS_version, needle):
+        version_index = self.version_index(TOS_version)
+        if version_index is None:
+            return None
+        return version_index.list_directory(needle)
+
+    def suggest(self, TOS_version, needle):
+        """ Return up to `MAX_SUGGESTIONS` near-miss names for a not-found
+        needle; None if they can't be had in time (see `VersionIndex.suggest()`).
+        """
+        version_index = self.version_index(TOS_version)
+        if version_index is None:
+            return []
+        return version_index.suggest(needle)
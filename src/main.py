@@ -1,9 +1,15 @@
 """ The TTD2 Discord chat bot. """
 
 import asyncio
+import concurrent.futures
+import functools
+import logging
 import pathlib
 import re
+import signal
 import sys
+import threading
+import time
 
 import appdirs
 import cachetools
@@ -15,6 +21,14 @@ if IS_OPENBSD:
 
 import common
 import data
+import index
+import metrics
+import querylog
+import replies
+import server
+import throttle
+
+log = logging.getLogger(__name__)
 
 # ==============================================================================
 
@@ -22,10 +36,66 @@ intents = discord.Intents.default()
 intents.members = True
 intents.messages = True
 intents.message_content = True
-client = discord.Client(intents=intents)
-
-db_con, db_cur = data.create_in_memory_database()
-recent_replies = cachetools.FIFOCache(maxsize=50)
+if common.SHARD_COUNT is None:
+    client = discord.Client(intents=intents)
+else:
+    client = discord.AutoShardedClient(
+        intents=intents, shard_ids=common.SHARD_IDS, shard_count=common.SHARD_COUNT
+    )
+tree = discord.app_commands.CommandTree(client)
+
+# For the event loop only; the index, used from lookup threads, has its own.
+db_con, db_cur = data.open_database()
+lookup_index = index.Index(*data.open_database())
+
+# (TOS version, needle key) -> (`RenderedFields`, suggestions).
+field_cache = cachetools.LRUCache(maxsize=common.FIELD_CACHE_SIZE)
+field_cache_stats = {"hits": 0, "misses": 0}
+field_cache_lock = threading.Lock()
+metrics.counter_functions["ttd2_field_cache_hits_total"] = lambda: field_cache_stats["hits"]
+metrics.counter_functions["ttd2_field_cache_misses_total"] = lambda: field_cache_stats["misses"]
+
+# Lookups run here so a slow one never stalls the event loop. The index is
+# read-only once built, so the workers share it without locking.
+lookup_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=common.LOOKUP_WORKERS, thread_name_prefix="lookup"
+)
+
+# In memory until `run()` opens the files; anything else importing this
+# (`replay.py`, `golden.py`, tests) must never touch the running bot's.
+reply_store = replies.ReplyStore(
+    maxsize=common.REPLY_STORE_SIZE, ttl=common.REPLY_STORE_TTL_SECONDS
+)
+query_log = None
+
+# (channel ID, message ID) -> latest edit of the message, while debouncing.
+pending_edits = {}
+# (channel ID, message ID) -> the lookups last asked for, answered or not (it
+# may still be queued, or have been coalesced or shed); edits compare to it.
+requested_lookups = cachetools.TTLCache(
+    maxsize=common.REPLY_STORE_SIZE, ttl=common.REPLY_STORE_TTL_SECONDS
+)
+
+# (time queued, coroutine function answering a message) for the workers.
+message_queue = asyncio.Queue(maxsize=common.MESSAGE_QUEUE_SIZE)
+message_workers = []
+
+# Fetched by `on_ready`; see `is_admin()`.
+admin_ids = set()
+
+# Set by `shards.run_shard()`: where a shard asks `shards.py` to reload.
+shard_reload_requests = None
+
+# Started by the first `on_ready` only: it runs again after a failed resume.
+background_tasks = []
+servers = []
+channel_buckets = throttle.TokenBuckets(common.CHANNEL_BUCKET_CAPACITY, common.CHANNEL_BUCKET_RATE)
+user_buckets = throttle.TokenBuckets(common.USER_BUCKET_CAPACITY, common.USER_BUCKET_RATE)
+# (channel ID, author ID, lookups) recently queued, and channels recently told
+# of drops.
+recent_requests = cachetools.TTLCache(maxsize=1024, ttl=common.COALESCE_SECONDS)
+shed_notices = cachetools.TTLCache(maxsize=1024, ttl=common.SHED_NOTICE_SECONDS)
+metrics.gauge_functions["ttd2_message_queue_length"] = lambda: message_queue.qsize()
 
 # ==============================================================================
 
@@ -37,16 +107,171 @@ async def change_status_task():
             await asyncio.sleep(15)
 
 
+def set_lookup_index(new_index):
+    """ Swap in a rebuilt index, dropping everything rendered from the old one. """
+    global lookup_index
+    lookup_index = new_index
+    with field_cache_lock:
+        field_cache.clear()
+
+
+def load_database_and_index(preload_versions=()):
+    """ Build from the TOS versions on disk, without applying them; return
+    them (see `common.read_TOS_versions()`) with the new database and index.
+    """
+    base_urls = common.read_TOS_versions()
+    con, cur = data.open_database(base_urls=base_urls)
+    new_index = index.Index(*data.open_database(base_urls=base_urls), base_urls)
+    for TOS_version in preload_versions:
+        version_index = new_index.version_index(TOS_version)
+        if version_index is not None:
+            version_index.build_suggestions()
+    return base_urls, con, cur, new_index
+
+
+reload_lock = asyncio.Lock()
+
+async def reload_index():
+    """ Rebuild the snapshot and index if the .DD files changed, then swap.
+
+    The build runs off the event loop. Lookups already running keep the
+    old index they started with; new ones see the new index once swapped.
+    The TOS versions on disk are only applied then, too: if the build fails,
+    it's logged and returned, and everything stays as it was.
+
+    A shard process asks `shards.py` instead, which rebuilds the index it
+    shares and restarts every shard with it; one private rebuild per shard
+    would end the sharing. It asks over a pipe: pledged, it can't signal.
+    """
+    global db_con, db_cur
+    if common.SHARD_COUNT is not None:
+        shard_reload_requests.send(None)
+        return None
+    async with reload_lock:
+        # Warm whatever was in use so the swap causes no first-use stalls.
+        # The old connection closes once the old index is no longer in use.
+        try:
+            base_urls, con, cur, new_index = await asyncio.get_running_loop().run_in_executor(
+                lookup_executor, load_database_and_index, lookup_index.loaded_versions()
+            )
+        except Exception as e:
+            log.exception("Reload failed; keeping the current index.")
+            return e
+        common.refresh_TOS_versions(base_urls)
+        db_con, db_cur = con, cur
+        set_lookup_index(new_index)
+    return None
+
+
+async def evict_idle_versions_task():
+    while True:
+        await asyncio.sleep(common.VERSION_IDLE_EVICT_SECONDS / 4)
+        lookup_index.evict_idle(common.VERSION_IDLE_EVICT_SECONDS)
+
+
+async def flush_reply_store_task():
+    while True:
+        await asyncio.sleep(common.REPLY_STORE_FLUSH_SECONDS)
+        await asyncio.get_running_loop().run_in_executor(None, reply_store.flush)
+
+
+class RenderedFields(tuple):
+    """ A lookup's result fields, (name, value) each: only as many as a message
+    shows, and one more to tell it was trimmed. `total` counts them all.
+    """
+
+    def __new__(cls, fields, total):
+        rendered = super().__new__(cls, fields)
+        rendered.total = total
+        return rendered
+
+
+def look_up_fields_many(lookups):
+    """ Return (fields, suggestions) for each (TOS version, needle), in order.
+
+    Cache misses are resolved with one batched index lookup per TOS version.
+    """
+    keys = [(TOS_version, index.needle_key(needle)) for TOS_version, needle in lookups]
+    results = {}
+    missed_keys = set()
+    misses = {}
+    with field_cache_lock:
+        for key, (TOS_version, needle) in zip(keys, lookups):
+            if key in results or key in missed_keys:
+                continue
+            cached = field_cache.get(key)
+            if cached is not None:
+                field_cache_stats["hits"] += 1
+                results[key] = cached
+            else:
+                field_cache_stats["misses"] += 1
+                missed_keys.add(key)
+                misses.setdefault(TOS_version, []).append(needle)
+
+    current_index = lookup_index
+    rendered = {}
+    # Rendered without the suggestions they should have; not to be cached.
+    unfinished = set()
+    for TOS_version, needles in misses.items():
+        lookup_needles = []
+        for needle in needles:
+            # "/Demo/" lists that directory, if there is one.
+            listing = None
+            if needle.endswith("/"):
+                listing = current_index.list_directory(TOS_version, needle)
+            if listing is not None:
+                rendered[(TOS_version, index.needle_key(needle))] = (
+                    RenderedFields([directory_listing_field(listing, TOS_version)], 1), ()
+                )
+            else:
+                lookup_needles.append(needle)
+
+        matches = current_index.look_up_many(TOS_version, lookup_needles)
+        for needle, (path_matches, symbol_matches) in zip(lookup_needles, matches):
+            # Records render their fields when asked; only ask for those shown.
+            shown = common.MAX_FIELDS_PER_MESSAGE + 1
+            fields = RenderedFields(
+                [symbol_field(sm) for sm in symbol_matches[:shown]]
+                + [path_field(pm) for pm in path_matches[:max(0, shown - len(symbol_matches))]],
+                len(symbol_matches) + len(path_matches)
+            )
+            key = (TOS_version, index.needle_key(needle))
+            suggestions = ()
+            if fields == ():
+                suggestions = current_index.suggest(TOS_version, needle)
+                if suggestions is None:
+                    unfinished.add(key)
+                suggestions = tuple(suggestions or ())
+            rendered[key] = (fields, suggestions)
+
+    with field_cache_lock:
+        for key, result in rendered.items():
+            # Don't let a lookup that straddled an index swap repopulate the cache.
+            if current_index is lookup_index and key not in unfinished:
+                result = field_cache.setdefault(key, result)
+            results[key] = result
+
+    return [results[key] for key in keys]
+
+
+def look_up_fields(TOS_version, needle):
+    """ Return the rendered result fields for a needle, and suggestions if none. """
+    return look_up_fields_many([(TOS_version, needle)])[0]
+
+
 def normalize_TOS_version(tv):
     if tv == "":
         return common.DEFAULT_TOS_VERSION
+    if tv == common.ALL_TOS_VERSIONS:
+        return tv
 
     index = [s.lower() for s in common.TOS_VERSIONS].index(tv.lower())
     if index is not None:
         return common.TOS_VERSIONS[index]
 
 
-async def process_msg(text):
+def extract_lookups(text):
+    """ Return a message's distinct lookups, and whether some were left out. """
     # A "lookup" is a (TOS_version, needle) pair.
     too_many_lookups = False
     lookups = []
@@ -57,98 +282,175 @@ async def process_msg(text):
             else:
                 too_many_lookups = True
                 break
+    return lookups, too_many_lookups
+
+
+async def process_msg(text, trace=None):
+    """ Return an embed answering a message's lookups; None if it has none.
+
+    Given a `trace` dict, fills it in for the query log: the lookups, result
+    counts, how long each stage took, and what was cached beforehand.
+    """
+    stages = {}
+    with metrics.timed("ttd2_extract_seconds", stages, "extract"):
+        lookups, too_many_lookups = extract_lookups(text)
     if lookups == []:
         return
+    return await process_lookups(lookups, too_many_lookups, trace, stages)
 
-    embed = discord.Embed(color = 0x55FFFF)
-    for (TOS_version, needle) in lookups:
+
+async def process_lookups(lookups, too_many_lookups=False, trace=None, stages=None):
+    """ Return an embed answering (TOS version, needle) lookups; see `process_msg()`. """
+    stages = {} if stages is None else stages
+    metrics.observe("ttd2_lookups_per_message", len(lookups), metrics.COUNT_BUCKETS)
+
+    # Validate every lookup first so the valid ones resolve in one batch.
+    MAX_NEEDLE_LEN = 100
+    errors = {}
+    valid_lookups = []
+    for i, (TOS_version, needle) in enumerate(lookups):
         try:
             TOS_version = normalize_TOS_version(TOS_version)
         except ValueError:
-            embed = embed_append_error(
-                embed,
-                f"TOS version not found.\nValid versions: {','.join(common.TOS_VERSIONS)}"
-            )
+            errors[i] = f"TOS version not found.\nValid versions: {','.join(common.TOS_VERSIONS)}"
             continue
 
-        MAX_NEEDLE_LEN = 100
         if len(needle) > MAX_NEEDLE_LEN:
-            embed = embed_append_error(
-                embed,
-                f"Search term too long: '{needle[:MAX_NEEDLE_LEN]} …' ({len(needle)}/{MAX_NEEDLE_LEN})"
-            )
+            errors[i] = f"Search term too long: '{needle[:MAX_NEEDLE_LEN]} …' ({len(needle)}/{MAX_NEEDLE_LEN})"
             continue
 
-        path_matches, symbol_matches = data.look_up(TOS_version, needle, db_con, db_cur)
+        valid_lookups.append((TOS_version, needle))
+
+    if trace is not None:
+        with field_cache_lock:
+            trace["warm"] = [
+                {
+                    "cached": (TOS_version, index.needle_key(needle)) in field_cache,
+                    "loaded": lookup_index.is_loaded(TOS_version),
+                }
+                for TOS_version, needle in valid_lookups
+            ]
+
+    with metrics.timed("ttd2_lookup_seconds", stages, "lookup"):
+        results = await asyncio.get_running_loop().run_in_executor(
+            lookup_executor, look_up_fields_many, valid_lookups
+        )
+
+    with metrics.timed("ttd2_embed_seconds", stages, "embed"):
+        embed = build_embed(lookups, errors, valid_lookups, iter(results), too_many_lookups)
+
+    if trace is not None:
+        counts = iter([fields.total for fields, _ in results])
+        trace.update(
+            lookups=lookups,
+            too_many=too_many_lookups,
+            valid_lookups=valid_lookups,
+            results=[None if i in errors else next(counts) for i in range(len(lookups))],
+            stages=stages,
+        )
+    return embed
 
-        if path_matches == [] and symbol_matches == []:
-            embed = embed_append_not_found(embed, needle, TOS_version)
-        else:
-            for sm in symbol_matches:
-                embed = embed_append_symbol(embed, sm, TOS_version)
 
-            for pm in path_matches:
-                embed = embed_append_path(embed, pm, TOS_version)
+def build_embed(lookups, errors, valid_lookups, results, too_many_lookups):
+    embed = discord.Embed(color = 0x55FFFF)
+    valid_lookups = iter(valid_lookups)
+    for i in range(len(lookups)):
+        if i in errors:
+            embed = embed_append_error(embed, errors[i])
+            continue
+
+        TOS_version, needle = next(valid_lookups)
+        fields, suggestions = next(results)
+
+        if fields == ():
+            embed = embed_append_not_found(embed, needle, TOS_version, suggestions)
+        else:
+            for name, value in fields:
+                embed.add_field(name=name, value=value, inline=False)
 
         if len(embed.fields) > common.MAX_FIELDS_PER_MESSAGE:
-            for i in range(len(embed.fields)-common.MAX_FIELDS_PER_MESSAGE+1):
+            trimmed = len(embed.fields)-common.MAX_FIELDS_PER_MESSAGE+1
+            for i in range(trimmed):
                 embed.remove_field(-1)
+            # Past those, fields weren't rendered at all.
+            metrics.increment("ttd2_trimmed_fields_total", trimmed + fields.total - len(fields))
 
             embed = embed_append_error(embed, "Too many results, trimmed output.")
             break
             
     if too_many_lookups:
+        metrics.increment("ttd2_trimmed_lookup_messages_total")
         embed = embed_append_error(embed, "Too many needles, trimmed output.")
 
     return embed
 
 # Embeds =======================================================================
 
-def embed_append_symbol(embed, symbol, TOS_version):
-    text = str()
-    if TOS_version != common.DEFAULT_TOS_VERSION:
-        text += f"(Version: {TOS_version})\n"
-    text += f"Type: {symbol['type']}\n"
-
-    if symbol["type"] == "OpCode":
-        text += \
-f"""
-Reference: [x86 reference: {symbol['name']}](https://www.felixcloutier.com/x86/{symbol['name'].lower()})
-
-See [::/Doc/ASM.DD.Z](https://tinkeros.github.io/WbTempleOS/Doc/Asm.html)
-And [::/Compliler/OpCodes.DD.Z](https://tinkeros.github.io/WbTempleOS/Compiler/OpCodes.html)\n
-"""
-    elif symbol["type"] == "Reg":
-        l = ("https://en.wikibooks.org/wiki/X86_Assembly/X86_Architecture"
-        +"#General-Purpose_Registers_(GPR)_-_16-bit_naming_conventions")
-        text += f"Reference: [Wikibooks: x86 Architecture]({l})\n"
-    else:
-        if symbol["file"] is not None:
-            link = data.path_to_link(symbol["file"], symbol["line"], TOS_version)
-            line_str = ", line " + str(symbol["line"])
-            text += f"Definition: [{symbol['file']}{line_str}]({link})\n"
+# Discord's limit on an embed field's text.
+MAX_FIELD_VALUE_LEN = 1024
 
-    embed.add_field(name=symbol['name'], value=text, inline=False)
-    return embed
+def symbol_field(symbol):
+    return symbol['name'], symbol['field_text']
 
 
-def embed_append_path(embed, path, TOS_version):
-    text = str()
-    if TOS_version != common.DEFAULT_TOS_VERSION:
-        text += f"(Version: {TOS_version})\n"
+def path_field(path):
+    return path['basename'], path['field_text']
 
-    link = data.path_to_link(path["full_path"], None, TOS_version)
-    text += f"Type: {path['type']}\nPath: [{path['full_path']}]({link})"
 
-    embed.add_field(name=path['basename'], value=text, inline=False)
-    return embed
+def join_within(items, max_len):
+    """ Join `items` with commas, ending in "… (N more)" if over `max_len`. """
+    text = ", ".join(items)
+    if len(text) <= max_len:
+        return text
+    for count in range(len(items) - 1, -1, -1):
+        text = ", ".join(items[:count]) + f", … ({len(items) - count} more)"
+        if len(text) <= max_len:
+            return text.lstrip(", ")
+    return ""
 
 
-def embed_append_not_found(embed, needle, TOS_version):
+def directory_listing_field(listing, TOS_version):
+    directory = listing.directory
     text = str()
-    if TOS_version != common.DEFAULT_TOS_VERSION:
+    if TOS_version == common.ALL_TOS_VERSIONS:
+        text += "(All versions)\n"
+    elif TOS_version != common.DEFAULT_TOS_VERSION:
         text += f"(Version: {TOS_version})\n"
+    text += f"Path: [{directory['full_path']}]({directory['link']})\n"
+
+    type_counts = sorted(listing.type_counts.items(), key=lambda tc: (-tc[1], tc[0]))
+    text += f"Files beneath: {sum(listing.type_counts.values())}"
+    if type_counts:
+        text += " (" + ", ".join(f"{t}: {c}" for t, c in type_counts) + ")"
+    text += "\n"
+
+    # Whatever room is left goes to the listing itself, half each at most.
+    room = MAX_FIELD_VALUE_LEN - len(text) - len("Directories: \nFiles: \n")
+    if listing.subdirectories:
+        subdirectories = join_within(
+            [f"{d['basename']}/ ({count})" for d, count in listing.subdirectories],
+            room // 2 if listing.files else room
+        )
+        text += f"Directories: {subdirectories}\n"
+        room -= len(subdirectories)
+    if listing.files:
+        text += f"Files: {join_within([f['basename'] for f in listing.files], room)}\n"
+
+    return directory['full_path'] + "/", text
+
+
+def embed_append_not_found(embed, needle, TOS_version, suggestions=()):
+    text = str()
+    version_prefix = ""
+    if TOS_version == common.ALL_TOS_VERSIONS:
+        text += "(All versions)\n"
+        version_prefix = f"({TOS_version})"
+    elif TOS_version != common.DEFAULT_TOS_VERSION:
+        text += f"(Version: {TOS_version})\n"
+        version_prefix = f"({TOS_version})"
     text += f"Path or symbol not found: {needle}\n"
+    if suggestions:
+        text += "Did you mean: " + ", ".join(f"%%{version_prefix}{s}" for s in suggestions) + "?\n"
 
     embed.add_field(name="Not found.", value=text, inline=False)
     return embed
@@ -158,46 +460,345 @@ def embed_append_error(embed, error_message):
     embed.add_field(name=common.EMBED_ERROR_STR, value=error_message, inline=False)
     return embed
 
+# Queueing =====================================================================
+
+async def shed(msg):
+    metrics.increment("ttd2_shed_messages_total")
+    if msg.channel.id not in shed_notices:
+        shed_notices[msg.channel.id] = True
+        await msg.channel.send("Too many lookups at once; some were skipped. Try again shortly.")
+
+
+async def enqueue_request(msg, answer, coalesce_key=None):
+    """ Queue `answer()` unless it repeats a recent request or is over a limit.
+
+    Requests over their channel's or user's rate, or past a full queue, are
+    dropped, so a flood in one channel is cut off before it can delay others.
+    """
+    if coalesce_key is not None and coalesce_key in recent_requests:
+        metrics.increment("ttd2_coalesced_messages_total")
+        return False
+
+    buckets = [channel_buckets[msg.channel.id], user_buckets[msg.author.id]]
+    if not throttle.take_all(buckets):
+        await shed(msg)
+        return False
+    try:
+        message_queue.put_nowait((time.monotonic(), answer))
+    except asyncio.QueueFull:
+        await shed(msg)
+        return False
+
+    if coalesce_key is not None:
+        recent_requests[coalesce_key] = True
+    return True
+
+
+async def message_worker_task():
+    while True:
+        queued_at, answer = await message_queue.get()
+        metrics.observe("ttd2_queue_wait_seconds", time.monotonic() - queued_at)
+        try:
+            await answer()
+        except Exception:
+            log.exception("Failed to answer a message.")
+        finally:
+            message_queue.task_done()
+
+# ==============================================================================
+
+async def fetch_admin_ids():
+    """ The IDs of the bot application's owner, or of its team's members. """
+    app_info = await client.application_info()
+    if app_info.team is not None:
+        return {m.id for m in app_info.team.members}
+    return {app_info.owner.id}
+
+
+async def is_admin(user):
+    """ Whether `user` owns the bot's application (or is on its team).
+
+    Anyone can send `%%!...`, so this never calls Discord; the IDs are
+    fetched on ready. Until then, nobody is an admin.
+    """
+    return user.id in admin_ids
+
+
+async def handle_admin_command(msg):
+    if msg.content.strip() == common.RELOAD_COMMAND:
+        error = await reload_index()
+        if error is not None:
+            await msg.reply(f"Reload failed: {error}"[:1900], mention_author=False)
+        elif common.SHARD_COUNT is not None:
+            await msg.reply("Reloading TOS datasets; shards will restart.", mention_author=False)
+        else:
+            await msg.reply("Reloaded TOS datasets.", mention_author=False)
+    elif msg.content.strip() == common.STATS_COMMAND:
+        await msg.reply(f"```\n{metrics.render_summary()[:1900]}\n```", mention_author=False)
+    elif msg.content.strip() == common.SYNC_COMMAND:
+        synced = await tree.sync()
+        await msg.reply(f"Synced {len(synced)} slash command(s).", mention_author=False)
+
+# Slash command ================================================================
+
+# Discord's limits on an autocomplete choice's name and value, and their number.
+MAX_CHOICE_LEN = 100
+MAX_CHOICES = 25
+
+@tree.command(name="ttd", description="Look up a TempleOS path or symbol, as %% does.")
+@discord.app_commands.describe(
+    needle="Path, file name or symbol; eg. WallPaperFish, /Demo/Graphics/",
+    version=f"TOS version (default: {common.DEFAULT_TOS_VERSION}; * for all)"
+)
+async def ttd_command(interaction, needle: str, version: str = ""):
+    # Only what a `%%` lookup could ask for; "%", say, would match every name.
+    needle = needle.strip()
+    if not common.NEEDLE_PATTERN.fullmatch(needle):
+        await interaction.response.send_message(
+            "Search terms are letters, digits and `_:/.*-`, not ending in `.`.", ephemeral=True
+        )
+        return
+
+    buckets = [channel_buckets[interaction.channel_id], user_buckets[interaction.user.id]]
+    if not throttle.take_all(buckets):
+        metrics.increment("ttd2_shed_messages_total")
+        await interaction.response.send_message(
+            "Too many lookups at once; try again shortly.", ephemeral=True
+        )
+        return
+
+    try:
+        deferred = not lookup_index.is_loaded(normalize_TOS_version(version))
+    except ValueError:
+        deferred = False  # Not a version; the error is sent at once.
+    if deferred:
+        # Building the version's index can outlast the 3 seconds Discord waits
+        # for a response; deferring shows "thinking…" and gives 15 minutes.
+        await interaction.response.defer()
+
+    with metrics.timed("ttd2_slash_command_seconds"):
+        trace = {}
+        embed = await process_lookups([(version, needle)], trace=trace)
+        if deferred:
+            await interaction.followup.send(embed=embed)
+        else:
+            await interaction.response.send_message(embed=embed)
+    await log_query(trace, interaction.created_at, interaction.guild_id, interaction.channel_id)
+
+
+@ttd_command.autocomplete("needle")
+async def ttd_needle_autocomplete(interaction, current):
+    """ Runs on every keystroke; Discord waits 3 seconds at most. """
+    try:
+        TOS_version = normalize_TOS_version(interaction.namespace.version or "")
+    except ValueError:
+        return []
+    with metrics.timed("ttd2_autocomplete_seconds"):
+        # Off the event loop too: a version's first completion builds its index.
+        completions = await asyncio.get_running_loop().run_in_executor(
+            lookup_executor, lookup_index.complete, TOS_version, current
+        )
+    return [
+        discord.app_commands.Choice(name=c, value=c)
+        for c in completions if len(c) <= MAX_CHOICE_LEN
+    ]
+
+
+@ttd_command.autocomplete("version")
+async def ttd_version_autocomplete(interaction, current):
+    choices = [
+        discord.app_commands.Choice(name=v, value=v) for v in common.TOS_VERSIONS
+    ] + [
+        discord.app_commands.Choice(name="* (all versions)", value=common.ALL_TOS_VERSIONS)
+    ]
+    return [c for c in choices if index.fold(c.value).startswith(index.fold(current))][:MAX_CHOICES]
+
 # ==============================================================================
 
 @client.event
 async def on_ready():
+    global admin_ids
+    try:
+        admin_ids = await fetch_admin_ids()
+    except discord.HTTPException:
+        log.exception("Failed to fetch the bot's owner; admin commands are off till next ready.")
     if IS_OPENBSD:
-        openbsd.pledge("stdio inet dns prot_exec")
-    await client.loop.create_task(change_status_task())
+        # Reloading reads the .DD files and rewrites the index snapshot.
+        openbsd.pledge("stdio rpath wpath cpath flock inet dns prot_exec")
+    try:
+        client.loop.add_signal_handler(
+            signal.SIGHUP, lambda: client.loop.create_task(reload_index())
+        )
+    except (AttributeError, NotImplementedError):
+        pass  # No SIGHUP (or no signal handlers) on this platform.
+    if message_workers == []:
+        for _ in range(common.MESSAGE_WORKERS):
+            message_workers.append(client.loop.create_task(message_worker_task()))
+    if background_tasks == []:
+        background_tasks.append(client.loop.create_task(change_status_task()))
+        if common.VERSION_IDLE_EVICT_SECONDS is not None:
+            background_tasks.append(client.loop.create_task(evict_idle_versions_task()))
+        if common.PERSIST_REPLIES:
+            background_tasks.append(client.loop.create_task(flush_reply_store_task()))
+        if common.METRICS_PORT is not None:
+            servers.append(await metrics.start_server(common.METRICS_HOST, common.METRICS_PORT))
+        if common.HTTP_PORT is not None:
+            # Shard processes all listen on the one port; the OS spreads requests.
+            servers.append(await server.start_server(
+                lambda: lookup_index, common.HTTP_HOST, common.HTTP_PORT, lookup_executor,
+                reuse_port=common.SHARD_COUNT is not None
+            ))
 
 
 @client.event
 async def on_message(msg):
-    embed = await process_msg(msg.content)
-    if embed is not None:
+    if msg.content.startswith(common.ADMIN_COMMAND_PREFIX) and await is_admin(msg.author):
+        await handle_admin_command(msg)
+        return
+
+    lookups, _ = extract_lookups(msg.content)
+    if lookups != []:
+        requested_lookups[(msg.channel.id, msg.id)] = tuple(lookups)
+        # Per author: someone else asking the same is answered too.
+        coalesce_key = (msg.channel.id, msg.author.id, tuple(lookups))
+        await enqueue_request(msg, functools.partial(answer_message, msg), coalesce_key)
+
+
+def query_plan(trace):
+    """ Each lookup's plan, for a slow query's record; runs on a lookup worker. """
+    valid_lookups = iter(zip(trace["valid_lookups"], trace["warm"]))
+    plan = []
+    for result in trace["results"]:
+        if result is None:
+            plan.append(None)
+            continue
+        (TOS_version, needle), warm = next(valid_lookups)
+        plan.append({**warm, **lookup_index.explain(TOS_version, needle)})
+    return plan
+
+
+async def log_query(trace, sent_at, guild_id, channel_id):
+    """ Add an answered message (or command) to the query log, if it's kept.
+    Call it once answered; the log is written by its own thread.
+    """
+    if query_log is None or "lookups" not in trace:
+        return
+    plan = None
+    if sum(trace["stages"].values()) >= common.SLOW_QUERY_SECONDS:
+        plan = await asyncio.get_running_loop().run_in_executor(
+            lookup_executor, query_plan, trace
+        )
+    query_log.record(sent_at.timestamp(), guild_id, channel_id, trace, plan)
+
+
+async def log_message_query(msg, trace):
+    await log_query(
+        trace,
+        msg.edited_at or msg.created_at,
+        msg.guild.id if msg.guild is not None else None,
+        msg.channel.id
+    )
+
+
+async def answer_message(msg):
+    with metrics.timed("ttd2_on_message_seconds"):
+        trace = {}
+        embed = await process_msg(msg.content, trace)
+        if embed is not None:
+            await send_reply(msg, embed)
+    await log_message_query(msg, trace)
+
+
+async def send_reply(msg, embed):
+    with metrics.timed("ttd2_reply_seconds"):
         reply = await msg.reply(embed = embed, mention_author=False)
-        recent_replies[msg] = reply
+    reply_store.set(msg.channel.id, msg.id, reply.id, extract_lookups(msg.content)[0])
+
+
+async def delete_reply(channel, reply_id):
+    try:
+        with metrics.timed("ttd2_delete_seconds"):
+            await channel.get_partial_message(reply_id).delete()
+    except discord.NotFound:
+        pass  # Already deleted by someone else.
 
 
+# Raw events fire even for messages no longer (or never) in discord.py's
+# message cache, eg. ones sent before a restart.
 @client.event
-async def on_message_edit(old_msg, new_msg):
-    embed = await process_msg(new_msg.content)
-    reply = recent_replies.get(old_msg)
+async def on_raw_message_edit(payload):
+    key = (payload.channel_id, payload.message_id)
+    if key in pending_edits:
+        pending_edits[key] = payload.message
+        return
+    pending_edits[key] = payload.message
+    try:
+        await asyncio.sleep(common.EDIT_DEBOUNCE_SECONDS)
+    finally:
+        msg = pending_edits.pop(key, None)
+    if msg is None:
+        return  # Deleted meanwhile.
+
+    # Discord also sends edits for embed unfurls, pins and the like; only a
+    # change to the lookups can change the reply. They're compared to what
+    # was last asked for, as the answer to that may not be sent yet; the
+    # reply store knows of messages from before a restart.
+    lookups, _ = extract_lookups(msg.content)
+    previous = requested_lookups.get(key)
+    if previous is None:
+        reply = reply_store.get(*key)
+        previous = () if reply is None else reply.lookups
+    if tuple(lookups) == previous:
+        metrics.increment("ttd2_unchanged_edits_total")
+        return
+    requested_lookups[key] = tuple(lookups)
 
-    if embed is not None:
-        if reply is not None:
-            await reply.edit(embed = embed)
-        else:
-            reply = await new_msg.reply(embed = embed, mention_author=False)
-            recent_replies[new_msg] = reply
+    if lookups == []:
+        # Only ever removes a reply; nothing to look up or rate limit.
+        await answer_edit(msg)
     else:
+        await enqueue_request(msg, functools.partial(answer_edit, msg))
+
+
+async def answer_edit(msg):
+    with metrics.timed("ttd2_on_message_edit_seconds"):
+        trace = {}
+        embed = await process_msg(msg.content, trace)
+        await update_reply(msg, embed)
+    await log_message_query(msg, trace)
+
+
+async def update_reply(msg, embed):
+    """ Edit an edited message's reply to `embed`, sending one if it has none,
+    or delete it if `embed` is None.
+    """
+    reply = reply_store.get(msg.channel.id, msg.id)
+
+    if embed is not None:
         if reply is not None:
-            await reply.delete()
-            del recent_replies[new_msg]
+            try:
+                with metrics.timed("ttd2_edit_seconds"):
+                    await msg.channel.get_partial_message(reply.reply_id).edit(embed = embed)
+                reply_store.set(
+                    msg.channel.id, msg.id, reply.reply_id, extract_lookups(msg.content)[0]
+                )
+                return
+            except discord.NotFound:
+                pass  # The reply was deleted; send a new one.
+        await send_reply(msg, embed)
+    elif reply is not None:
+        reply_store.pop(msg.channel.id, msg.id)
+        await delete_reply(msg.channel, reply.reply_id)
 
 
 @client.event
-async def on_message_delete(msg):
-    reply = recent_replies.get(msg)
-    if reply is not None:
-        await reply.delete()
-        del recent_replies[msg]
+async def on_raw_message_delete(payload):
+    pending_edits.pop((payload.channel_id, payload.message_id), None)
+    requested_lookups.pop((payload.channel_id, payload.message_id), None)
+    with metrics.timed("ttd2_on_message_delete_seconds"):
+        reply = reply_store.pop(payload.channel_id, payload.message_id)
+        if reply is not None:
+            await delete_reply(client.get_partial_messageable(payload.channel_id), reply.reply_id)
 
 
 # ==============================================================================
@@ -232,11 +833,46 @@ def get_token():
 
 # ==============================================================================
 
-if __name__ == "__main__":
+def open_files():
+    """ Persist the reply store and open the query log, as configured. Each
+    shard process answers its own guilds, so keeps its own files.
+    """
+    global reply_store, query_log
+    shards = None
+    if common.SHARD_COUNT is not None:
+        shards = f"{'-'.join(map(str, common.SHARD_IDS))}-of-{common.SHARD_COUNT}"
+
+    if common.PERSIST_REPLIES:
+        reply_store_path = replies.DEFAULT_PATH
+        if shards is not None:
+            reply_store_path = reply_store_path.with_name(f"replies-{shards}.sqlite3")
+        reply_store = replies.ReplyStore(
+            reply_store_path,
+            maxsize=common.REPLY_STORE_SIZE,
+            ttl=common.REPLY_STORE_TTL_SECONDS
+        )
+    if common.QUERY_LOG_PATH is not None:
+        query_log_path = pathlib.Path(common.QUERY_LOG_PATH)
+        if shards is not None:
+            query_log_path = query_log_path.with_stem(f"{query_log_path.stem}-{shards}")
+        query_log = querylog.QueryLog(query_log_path, common.QUERY_LOG_FLUSH_SECONDS)
+
+
+def run():
+    open_files()
     try:
         client.run(get_token())
     except (FileNotFoundError, discord.errors.LoginFailure) as e:
         print("!!! FAILED !!!")
         print(e)
         print("!!! SET TOKEN AND TRY AGAIN !!!")
-        set_token()
\ No newline at end of file
+        if common.SHARD_COUNT is None:
+            set_token()
+    finally:
+        reply_store.flush()
+        if query_log is not None:
+            query_log.close()
+
+
+if __name__ == "__main__":
+    run()
\ No newline at end of file
@@ -0,0 +1,135 @@
+""" Counters, gauges and histograms for the bot, served as Prometheus-style text.
+
+All updates happen on the event loop thread, so nothing here is locked.
+"""
+
+import bisect
+import contextlib
+import time
+
+from aiohttp import web
+
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 15, 25, 50)
+
+# =============================================================================
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the `q` quantile (max if past the last). """
+        threshold = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.bucket_counts):
+            cumulative += count
+            if cumulative >= threshold:
+                return bound
+        return self.max
+
+
+histograms = {}
+counters = {}
+# Counters kept elsewhere, read when rendered: name -> zero-argument callable.
+counter_functions = {}
+# Likewise for gauges: values that go down as well as up, eg. a queue's length.
+gauge_functions = {}
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS):
+    histogram = histograms.get(name)
+    if histogram is None:
+        histogram = histograms[name] = Histogram(buckets)
+    histogram.observe(value)
+
+
+def increment(name, amount=1):
+    counters[name] = counters.get(name, 0) + amount
+
+
+@contextlib.contextmanager
+def timed(name, timings=None, key=None):
+    """ Observe how long the `with` block takes, in seconds, under `name`.
+
+    With `timings`, it's also stored there, under `key`.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe(name, elapsed)
+        if timings is not None:
+            timings[key] = elapsed
+
+# =============================================================================
+
+def current_values():
+    """ Every counter and gauge, as {name: (type, value)}. """
+    values = {name: ("counter", value) for name, value in counters.items()}
+    for name, function in counter_functions.items():
+        values[name] = ("counter", function())
+    for name, function in gauge_functions.items():
+        values[name] = ("gauge", function())
+    return values
+
+
+def render_prometheus():
+    lines = []
+    for name, (metric_type, value) in sorted(current_values().items()):
+        lines += [f"# TYPE {name} {metric_type}", f"{name} {value}"]
+
+    for name, histogram in sorted(histograms.items()):
+        lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {histogram.count}')
+        lines.append(f"{name}_sum {histogram.sum}")
+        lines.append(f"{name}_count {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+def render_summary():
+    """ A short plain-text digest, small enough for a chat message. """
+    lines = []
+    for name, histogram in sorted(histograms.items()):
+        scale, unit = (1000, "ms") if name.endswith("_seconds") else (1, "")
+        lines.append(
+            f"{name}: n={histogram.count}"
+            f" p50<={histogram.quantile(0.5) * scale:g}{unit}"
+            f" p99<={histogram.quantile(0.99) * scale:g}{unit}"
+            f" max={histogram.max * scale:.3g}{unit}"
+        )
+    for name, (metric_type, value) in sorted(current_values().items()):
+        lines.append(f"{name}: {value}")
+    return "\n".join(lines) or "No metrics yet."
+
+
+async def handle_metrics(request):
+    return web.Response(text=render_prometheus(), content_type="text/plain")
+
+
+async def start_server(host, port):
+    """ Serve `GET /metrics` on the running event loop; returns the runner. """
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
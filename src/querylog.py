@@ -0,0 +1,105 @@
+""" Append-only log of the lookups the bot answers, one JSON line each.
+
+A record:
+
+    {"time": 1760780000.5, "guild_id": 1, "channel_id": 2,
+     "lookups": [["", "Cd"], ["TinkerOS", "*Fish*"]], "too_many": false,
+     "results": [1, 3], "stages": {"extract": 1e-05, "lookup": 0.0004, "embed": 6e-05},
+     "slow": false}
+
+`lookups` are as written in the message; `results` counts each one's result
+fields (null for a bad version or needle). A slow record also has a `plan`
+per lookup: whether its result was cached and its version loaded, and how
+the index matched it (see `index.VersionIndex.explain()`).
+"""
+
+import json
+import pathlib
+import queue
+import threading
+import time
+
+# =============================================================================
+
+# Queued by `flush()`: write out everything before it.
+FLUSH = object()
+
+
+class QueryLog:
+    """ Appends records to `path`, from a thread of its own, so recording
+    never waits on the disk. It writes them out at least every `flush_seconds`.
+    """
+
+    def __init__(self, path, flush_seconds=5):
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8", buffering=64 * 1024)
+        self.flush_seconds = flush_seconds
+        self.records = queue.Queue()
+        self.writer = threading.Thread(target=self.write_records, name="query-log", daemon=True)
+        self.writer.start()
+
+    def write_records(self):
+        """ The writer thread: until `close()`, write each queued record. """
+        flushed_at = time.monotonic()
+        while True:
+            try:
+                record = self.records.get(timeout=self.flush_seconds)
+            except queue.Empty:
+                record, queued = FLUSH, False
+            else:
+                queued = True
+            try:
+                if record is None:
+                    return
+                if record is not FLUSH:
+                    self.file.write(json.dumps(record) + "\n")
+                if record is FLUSH or time.monotonic() - flushed_at >= self.flush_seconds:
+                    self.file.flush()
+                    flushed_at = time.monotonic()
+            finally:
+                if queued:
+                    self.records.task_done()
+
+    def record(self, time, guild_id, channel_id, trace, plan=None):
+        """ Add a message's record; `trace` as filled in by `main.process_msg()`. """
+        record = {
+            "time": round(time, 3),
+            "guild_id": guild_id,
+            "channel_id": channel_id,
+            "lookups": trace["lookups"],
+            "too_many": trace["too_many"],
+            "results": trace["results"],
+            "stages": {stage: round(seconds, 6) for stage, seconds in trace["stages"].items()},
+            "slow": plan is not None,
+        }
+        if plan is not None:
+            record["plan"] = plan
+        self.records.put(record)
+
+    def flush(self):
+        """ Write out every record added so far; waits until it's done. """
+        self.records.put(FLUSH)
+        self.records.join()
+
+    def close(self):
+        self.records.put(None)
+        self.writer.join()
+        self.file.close()
+
+
+def read(path):
+    """ Yield a log's records, in order; a last line cut off mid-write is skipped. """
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def message_text(record):
+    """ A message asking for a record's lookups, as they were written. """
+    return " ".join(
+        f"%%({TOS_version}){needle}" if TOS_version else f"%%{needle}"
+        for TOS_version, needle in record["lookups"]
+    )
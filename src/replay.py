@@ -0,0 +1,95 @@
+""" Replay a query log through `main.process_msg()`, without Discord.
+
+Run from `src/`, eg.:
+
+    python replay.py queries.jsonl              # At the pace it was recorded.
+    python replay.py --speed 10 queries.jsonl   # Ten times as fast.
+    python replay.py --speed 0 queries.jsonl    # As fast as it'll go.
+
+Up to `common.MESSAGE_WORKERS` messages are answered at once, as in the bot.
+A message's latency counts from when it was due, so any wait for a worker
+shows in the tail. See `common.QUERY_LOG_PATH` to record a log.
+"""
+
+import argparse
+import asyncio
+import time
+
+import bench
+import common
+import main
+import querylog
+
+# =============================================================================
+
+async def replay(records, speed=1, workers=common.MESSAGE_WORKERS):
+    """ Answer each record's message when due, `speed` times as fast as logged
+    (0: all at once). Return the latencies, and the seconds it took overall.
+    """
+    records = sorted(records, key=lambda r: r["time"])
+    semaphore = asyncio.Semaphore(workers)
+    latencies = []
+
+    async def answer(text, due):
+        async with semaphore:
+            await main.process_msg(text)
+        latencies.append(time.perf_counter() - due)
+
+    start = time.perf_counter()
+    tasks = []
+    for record in records:
+        due = start
+        if speed > 0:
+            due = start + (record["time"] - records[0]["time"]) / speed
+            await asyncio.sleep(max(0, due - time.perf_counter()))
+        tasks.append(asyncio.create_task(answer(querylog.message_text(record), due)))
+    await asyncio.gather(*tasks)
+    return latencies, time.perf_counter() - start
+
+
+def summarize(records, latencies, elapsed):
+    """ Throughput (per second) and latency percentiles (in seconds) of a replay. """
+    latencies = sorted(latencies)
+    lookups = sum(len(r["lookups"]) for r in records)
+    return {
+        "messages": len(latencies),
+        "lookups": lookups,
+        "seconds": elapsed,
+        "messages_per_second": len(latencies) / elapsed if elapsed else 0,
+        "lookups_per_second": lookups / elapsed if elapsed else 0,
+        **{
+            f"p{p}": bench.percentile(latencies, p) if latencies else 0
+            for p in (50, 90, 99)
+        },
+        "max": latencies[-1] if latencies else 0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("log", help="query log to replay")
+    parser.add_argument(
+        "--speed", type=float, default=1,
+        help="how many times faster than recorded (0: as fast as possible)"
+    )
+    parser.add_argument("--workers", type=int, default=common.MESSAGE_WORKERS)
+    args = parser.parse_args()
+
+    records = list(querylog.read(args.log))
+    hits, misses = main.field_cache_stats["hits"], main.field_cache_stats["misses"]
+    latencies, elapsed = asyncio.run(replay(records, args.speed, args.workers))
+    summary = summarize(records, latencies, elapsed)
+
+    print(
+        f"{summary['messages']} messages, {summary['lookups']} lookups"
+        f" in {summary['seconds']:.2f}s:"
+        f" {summary['messages_per_second']:.0f} messages/s,"
+        f" {summary['lookups_per_second']:.0f} lookups/s"
+    )
+    print(
+        "Latency:"
+        + "".join(f" {p} {summary[p] * 1e3:.2f}ms" for p in ("p50", "p90", "p99", "max"))
+    )
+    hits = main.field_cache_stats["hits"] - hits
+    misses = main.field_cache_stats["misses"] - misses
+    print(f"Field cache: {hits} hits, {misses} misses")
@@ -0,0 +1,137 @@
+""" Which reply the bot sent to which message, by ID, optionally kept on disk. """
+
+import collections
+import json
+import pathlib
+import sqlite3
+import threading
+import time
+
+import appdirs
+
+DEFAULT_PATH = pathlib.Path(appdirs.user_cache_dir("TTD2_bot")).joinpath("replies.sqlite3")
+
+# Bump when the `replies` table changes; older files are emptied, not migrated.
+STORE_FORMAT_VERSION = 2
+
+# `lookups`: the (TOS version, needle) lookups the reply answered, in order.
+Reply = collections.namedtuple("Reply", ["reply_id", "lookups", "stored"])
+
+# =============================================================================
+
+class ReplyStore:
+    """ (channel ID, message ID) -> `Reply`.
+
+    Holds at most `maxsize` entries, each for at most `ttl` seconds, oldest
+    dropped first. With a `path`, entries are kept in a SQLite file there
+    and read back on start, so they outlive the process. Changes reach the
+    file only on `flush()`, which may run on another thread: the event loop
+    never waits on the disk.
+    """
+
+    def __init__(self, path=None, maxsize=10_000, ttl=24 * 60 * 60, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        # Oldest first.
+        self.replies = collections.OrderedDict()
+        # Changes not yet flushed: (channel ID, message ID) -> `Reply`, or None
+        # to delete. `lock` covers it; `flush_lock` keeps flushes in order.
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+        self.con = None
+        if path is not None:
+            pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self.con = sqlite3.connect(path, check_same_thread=False)
+            with self.con:
+                if self.con.execute("PRAGMA user_version").fetchone()[0] != STORE_FORMAT_VERSION:
+                    self.con.execute("DROP TABLE IF EXISTS `replies`")
+                    self.con.execute(f"PRAGMA user_version = {STORE_FORMAT_VERSION}")
+                self.con.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS `replies` (
+                        channel_id INTEGER,
+                        message_id INTEGER,
+                        reply_id INTEGER,
+                        lookups TEXT,
+                        stored REAL,
+                        PRIMARY KEY (channel_id, message_id)
+                    )
+                    """
+                )
+                self.con.execute("CREATE INDEX IF NOT EXISTS STORED ON `replies` (stored)")
+                self.con.execute("DELETE FROM `replies` WHERE stored < (?)", [clock() - ttl])
+            rows = self.con.execute(
+                """
+                SELECT channel_id, message_id, reply_id, lookups, stored FROM `replies`
+                ORDER BY stored DESC LIMIT (?)
+                """,
+                [maxsize]
+            ).fetchall()
+            for channel_id, message_id, reply_id, lookups, stored in reversed(rows):
+                lookups = tuple(tuple(lookup) for lookup in json.loads(lookups))
+                self.replies[(channel_id, message_id)] = Reply(reply_id, lookups, stored)
+
+    def __len__(self):
+        return len(self.replies)
+
+    def expire(self):
+        """ Drop entries past their time to live, or past `maxsize`. """
+        expired = []
+        deadline = self.clock() - self.ttl
+        while self.replies:
+            key, reply = next(iter(self.replies.items()))
+            if reply.stored >= deadline and len(self.replies) <= self.maxsize:
+                break
+            del self.replies[key]
+            expired.append(key)
+        if expired and self.con is not None:
+            with self.lock:
+                self.pending.update(dict.fromkeys(expired))
+
+    def get(self, channel_id, message_id):
+        """ Return a message's `Reply`; None if there's none. """
+        self.expire()
+        return self.replies.get((channel_id, message_id))
+
+    def set(self, channel_id, message_id, reply_id, lookups=()):
+        reply = Reply(reply_id, tuple(lookups), self.clock())
+        self.replies.pop((channel_id, message_id), None)
+        self.replies[(channel_id, message_id)] = reply
+        if self.con is not None:
+            with self.lock:
+                self.pending[(channel_id, message_id)] = reply
+        self.expire()
+
+    def pop(self, channel_id, message_id):
+        """ Forget and return a message's `Reply`; None if there's none. """
+        self.expire()
+        reply = self.replies.pop((channel_id, message_id), None)
+        if reply is not None and self.con is not None:
+            with self.lock:
+                self.pending[(channel_id, message_id)] = None
+        return reply
+
+    def flush(self):
+        """ Write the changes made since the last flush, in one transaction. """
+        if self.con is None:
+            return
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            if not pending:
+                return
+            with self.con:
+                self.con.executemany(
+                    "DELETE FROM `replies` WHERE channel_id = (?) AND message_id = (?)",
+                    [key for key, reply in pending.items() if reply is None]
+                )
+                self.con.executemany(
+                    "INSERT OR REPLACE INTO `replies` VALUES (?, ?, ?, ?, ?)",
+                    [
+                        [*key, reply.reply_id, json.dumps(reply.lookups), reply.stored]
+                        for key, reply in pending.items() if reply is not None
+                    ]
+                )
@@ -0,0 +1,132 @@
+""" HTTP/JSON lookup service, run inside the bot or on its own.
+
+Run from `src/`, eg. `python server.py --port 8080`, then:
+
+    curl 'http://127.0.0.1:8080/lookup?needle=Cd&version=TinkerOS'
+    curl -d '{"lookups": [{"needle": "Cd"}, {"needle": "C:/Adam"}]}' \\
+        http://127.0.0.1:8080/lookup/batch
+
+A lookup's result is the same JSON as `cli.py` prints, less its source.
+"""
+
+import argparse
+import asyncio
+import collections
+
+from aiohttp import web
+
+import common
+import data
+import index
+import metrics
+
+MAX_BATCH_LOOKUPS = 1000
+MAX_NEEDLE_LEN = 100
+KEEPALIVE_TIMEOUT_SECONDS = 75
+
+# =============================================================================
+
+def look_up_json(lookup_index, lookups):
+    """ Resolve (TOS version, needle) lookups to JSON-ready results, in order.
+
+    Bad lookups get an "error" rather than failing the whole batch.
+    """
+    results = [None] * len(lookups)
+    needles_by_version = collections.defaultdict(list)
+    for i, (TOS_version, needle) in enumerate(lookups):
+        if not isinstance(needle, str) or not 0 < len(needle) <= MAX_NEEDLE_LEN:
+            results[i] = {
+                "needle": needle, "error": f"Needle must be 1-{MAX_NEEDLE_LEN} characters."
+            }
+            continue
+        if not isinstance(TOS_version, str):
+            results[i] = {"needle": needle, "error": "TOS version must be a string."}
+            continue
+        needles_by_version[TOS_version or common.DEFAULT_TOS_VERSION].append((i, needle))
+
+    for TOS_version, needles in needles_by_version.items():
+        version_index = lookup_index.version_index(TOS_version)
+        if version_index is None:
+            for i, needle in needles:
+                results[i] = {
+                    "needle": needle, "TOS_version": TOS_version,
+                    "error": "TOS version not found."
+                }
+            continue
+        matches = lookup_index.look_up_many(version_index.TOS_version, [n for _, n in needles])
+        for (i, needle), (paths, symbols) in zip(needles, matches):
+            results[i] = {
+                "needle": needle,
+                **data.matches_as_json(version_index.TOS_version, paths, symbols)
+            }
+    return results
+
+
+def make_app(get_index, executor=None):
+    """ Build the service around `get_index()`, which returns the index to use.
+
+    Passing the bot's own index (through a function, so a reload's swap is
+    picked up) shares it rather than loading a second copy. Lookups run on
+    `executor` (default: the loop's), off the event loop.
+    """
+    async def run_lookups(lookups):
+        with metrics.timed("ttd2_http_lookup_seconds"):
+            return await asyncio.get_running_loop().run_in_executor(
+                executor, look_up_json, get_index(), lookups
+            )
+
+    async def handle_lookup(request):
+        needle = request.query.get("needle")
+        if needle is None:
+            raise web.HTTPBadRequest(text="Missing `needle` parameter.")
+        [result] = await run_lookups([(request.query.get("version", ""), needle)])
+        return web.json_response(result, status=400 if "error" in result else 200)
+
+    async def handle_lookup_batch(request):
+        try:
+            body = await request.json()
+            lookups = [(l.get("version", ""), l.get("needle")) for l in body["lookups"]]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise web.HTTPBadRequest(
+                text='Expected {"lookups": [{"needle": ..., "version": ...}, ...]}.'
+            )
+        if len(lookups) > MAX_BATCH_LOOKUPS:
+            raise web.HTTPRequestEntityTooLarge(
+                max_size=MAX_BATCH_LOOKUPS, actual_size=len(lookups)
+            )
+        return web.json_response({"results": await run_lookups(lookups)})
+
+    async def handle_versions(request):
+        return web.json_response(common.TOS_VERSIONS)
+
+    app = web.Application()
+    app.router.add_get("/lookup", handle_lookup)
+    app.router.add_post("/lookup/batch", handle_lookup_batch)
+    app.router.add_get("/versions", handle_versions)
+    app.router.add_get("/metrics", metrics.handle_metrics)
+    return app
+
+
+async def start_server(get_index, host, port, executor=None, reuse_port=False):
+    """ Serve on the running event loop (eg. the bot's); returns the runner. """
+    runner = web.AppRunner(
+        make_app(get_index, executor), keepalive_timeout=KEEPALIVE_TIMEOUT_SECONDS
+    )
+    await runner.setup()
+    await web.TCPSite(runner, host, port, reuse_port=reuse_port or None).start()
+    return runner
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    lookup_index = index.Index(*data.open_database())
+    web.run_app(
+        make_app(lambda: lookup_index),
+        host=args.host,
+        port=args.port,
+        keepalive_timeout=KEEPALIVE_TIMEOUT_SECONDS
+    )
@@ -0,0 +1,160 @@
+""" Run the bot as several processes, each with some of its Discord shards.
+
+Run from `src/`, eg. `python shards.py --shards 8 --processes 4`.
+
+The snapshot and the lookup index are built once, here, before the shard
+processes are forked, so they start at once and share the index's memory
+(copy-on-write; `gc.freeze()` keeps the collector from writing to it) rather
+than each building a copy. Each reopens the read-only, memory-mapped snapshot
+for itself.
+
+SIGHUP (or `%%!reload` in any shard, asking over a pipe) reloads: the index
+is rebuilt here, the old shards answering meanwhile, then every shard is
+restarted with the new one, reconnecting to Discord. Shards never reload by
+themselves, as that would leave each with a private copy.
+"""
+
+import argparse
+import gc
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+
+import common
+import data
+import index
+
+log = logging.getLogger(__name__)
+
+# =============================================================================
+
+def build_shared_index():
+    """ Build the index from the TOS versions on disk; only once it's built
+    are they applied (in `common`, for the shards to inherit).
+    """
+    base_urls = common.read_TOS_versions()
+    shared_index = index.Index(*data.open_database(base_urls=base_urls), base_urls)
+    for TOS_version in [*base_urls, common.ALL_TOS_VERSIONS]:
+        # Built here, so shared too; a shard building it would keep its own.
+        shared_index.version_index(TOS_version).build_suggestions()
+    common.refresh_TOS_versions(base_urls)
+    return shared_index
+
+
+def run_shard(process_number, shard_ids, shard_count, shared_index, reload_requests):
+    common.SHARD_IDS = shard_ids
+    common.SHARD_COUNT = shard_count
+    # Evicted versions would be rebuilt privately, unshared; keep them all.
+    common.VERSION_IDLE_EVICT_SECONDS = None
+    if common.METRICS_PORT is not None:
+        # Each process has its own metrics, so its own port.
+        common.METRICS_PORT += process_number
+    # Exit cleanly when stopped, flushing the query log.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    import main
+    # Its own connection, as ever; the parent's isn't safe to share.
+    shared_index.reconnect(*data.open_database())
+    main.set_lookup_index(shared_index)
+    main.shard_reload_requests = reload_requests
+    main.run()
+
+
+def split_shards(shard_count, process_count):
+    """ Deal shard IDs out to processes, round robin. """
+    return [list(range(shard_count))[i::process_count] for i in range(process_count)]
+
+
+def fork_shards(
+    shared_index, shard_count, process_count, target=run_shard, reload_requests=None
+):
+    """ Start the shard processes; each may send to `reload_requests` (the
+    sending end of a one-way pipe) to have them all reloaded.
+    """
+    gc.freeze()
+
+    # Forking (never spawning) is what shares the index.
+    context = multiprocessing.get_context("fork")
+    processes = []
+    for process_number, shard_ids in enumerate(split_shards(shard_count, process_count)):
+        process = context.Process(
+            target=target,
+            args=(process_number, shard_ids, shard_count, shared_index, reload_requests),
+            name=f"shards-{'-'.join(map(str, shard_ids))}"
+        )
+        process.start()
+        processes.append(process)
+    return processes
+
+
+def start_shards(shard_count, process_count, target=run_shard, reload_requests=None):
+    return fork_shards(
+        build_shared_index(), shard_count, process_count, target, reload_requests
+    )
+
+
+def stop_shards(processes):
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join()
+
+
+def restart_shards(
+    processes, shard_count, process_count, target=run_shard, reload_requests=None
+):
+    """ Rebuild the index while `processes` still answer, then replace them.
+
+    If the rebuild fails, it's logged and `processes` are returned, untouched.
+    """
+    try:
+        shared_index = build_shared_index()
+    except Exception:
+        log.exception("Reload failed; the shards keep the current index.")
+        return processes
+    stop_shards(processes)
+    # Only the new index need stay frozen; the old one's objects may go.
+    gc.unfreeze()
+    return fork_shards(shared_index, shard_count, process_count, target, reload_requests)
+
+
+def supervise(shard_count, process_count, target=run_shard):
+    """ Run the shards until they've all exited, restarting them on SIGHUP or
+    when one asks.
+    """
+    reload_receiver, reload_requests = multiprocessing.get_context("fork").Pipe(duplex=False)
+    processes = start_shards(shard_count, process_count, target, reload_requests)
+    reload_requested = []
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_requested.append(signum))
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_shards(processes))
+
+    while any(p.is_alive() for p in processes):
+        ready = multiprocessing.connection.wait(
+            [reload_receiver, *(p.sentinel for p in processes)], timeout=1
+        )
+        if reload_receiver in ready:
+            while reload_receiver.poll():
+                reload_requested.append(reload_receiver.recv())
+        if reload_requested:
+            reload_requested.clear()
+            processes = restart_shards(
+                processes, shard_count, process_count, target, reload_requests
+            )
+    return max(abs(p.exitcode or 0) for p in processes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--shards", type=int, required=True, help="total shard count")
+    parser.add_argument(
+        "--processes", type=int, default=None,
+        help="processes to spread them over (default: one per CPU, at most one per shard)"
+    )
+    args = parser.parse_args()
+    process_count = min(args.shards, args.processes or os.cpu_count() or 1)
+
+    sys.exit(supervise(args.shards, process_count))
@@ -5,15 +5,38 @@ tests and are spinning up / tearing down async loops.
 """
 
 import asyncio
+import datetime
+import gc
+import io
+import json
+import multiprocessing
+import os
 import re
+import shutil
+import signal
+import sqlite3
+import threading
+import time
+import types
 
 import pytest
 import hypothesis
 import discord
+from aiohttp import test_utils
 
 import main
+import shards
+import cli
 import data
+import golden
+import index
 import common
+import metrics
+import querylog
+import replay
+import replies
+import server
+import throttle
 
 # ==============================================================================
 def field_compare(f1, f2):
@@ -71,27 +94,794 @@ def test_process_msg_finds_files_with_incomplete_extensions():
 
 
 def test_process_msg_returns_result_for_all_complete_paths():
+    async def check_all():
+        for version in common.TOS_VERSIONS:
+            for path in data.get_all_paths(version, main.db_con, main.db_cur):
+                if path['basename'] == "/":
+                    continue
+                r = await main.process_msg(f"Some text %%({version}){path['full_path']} ...")
+                field_names = [f.name for f in r.fields]
+                found = False
+                for name in field_names:
+                    m = common.BASENAME_NO_EXTENSIONS_PATTERN.match(name)
+                    assert(m is not None)
+                    if m.group(0) == name:
+                        found = True
+                assert found == True
+    asyncio.run(check_all())
+
+
+def test_process_msg_returns_result_for_all_symbols():
+    async def check_all():
+        for version in common.TOS_VERSIONS:
+            for s in data.get_all_symbols(version, main.db_con, main.db_cur):
+                r = await main.process_msg(f"Some text %%({version}){s['name']} ...")
+                field_names = [f.name for f in r.fields]
+                assert s["name"] in field_names
+    asyncio.run(check_all())
+
+
+def test_golden_corpus_matches_every_engine_within_budgets():
+    mismatches, latencies = golden.check(
+        golden.load_corpus(), main.db_con, main.db_cur, main.lookup_index
+    )
+    assert mismatches == []
+    # Generous by default, so a busy or slow machine doesn't fail the suite;
+    # `python golden.py` holds the budgets as they are.
+    assert golden.over_budget(latencies, scale=golden.budget_scale(default=10)) == []
+
+    # A lookup engine that drifts is caught, and so is one that slows down.
+    engines = golden.lookup_engines(main.db_con, main.db_cur, main.lookup_index)
+    look_up = engines["index"]
+    engines["index"] = lambda v, n: look_up(v, n.rstrip("*")) if "*" in n else look_up(v, n)
+    mismatches, latencies = golden.check_engines(golden.load_corpus(), engines)
+    assert {m[0] for m in mismatches} == {"index"}
+    assert {m[2] for m in mismatches} == {"wildcard"}
+    assert golden.over_budget(latencies, scale=0) != []
+
+
+def test_index_look_up_matches_sql_look_up():
     for version in common.TOS_VERSIONS:
+        needles = {"/", "*Fish*", "/Demo/*/*.HC", "Doc_Clear", "c:/adam", "charter"}
         for path in data.get_all_paths(version, main.db_con, main.db_cur):
-            if path['basename'] == "/":
-                continue
-            r = asyncio.run(main.process_msg(f"Some text %%({version}){path['full_path']} ..."))
-            field_names = [f.name for f in r.fields]
-            found = False
-            for name in field_names:
-                m = common.BASENAME_NO_EXTENSIONS_PATTERN.match(name)
-                assert(m is not None)
-                if m.group(0) == name:
-                    found = True
-            assert found == True
+            needles |= {path["full_path"], path["basename"].split(".")[0].lower()}
+        for symbol in data.get_all_symbols(version, main.db_con, main.db_cur):
+            needles |= {symbol["name"], symbol["name"].upper()}
 
+        for needle in needles:
+            assert (main.lookup_index.look_up(version, needle)
+                == data.look_up(version, needle, main.db_con, main.db_cur))
 
-def test_process_msg_returns_result_for_all_symbols():
+
+def test_index_wildcards_only_check_ngram_candidates():
+    basenames = main.lookup_index.version_index("TempleOS_5.3").basenames
+    candidates = basenames.like_candidates(index.like_parse("%fish%"))
+    assert "wallpaperfish.hc.z" in candidates
+    assert len(candidates) < len(basenames.sorted_keys) / 10
+
+
+def test_process_msg_suggests_near_misses():
+    for TOS_version in common.TOS_VERSIONS:
+        main.lookup_index.version_index(TOS_version).build_suggestions()
+    result = asyncio.run(main.process_msg("%%DocCLaer %%WallpaperFsh"))
+    assert "Did you mean: %%DocClear?" in result.fields[0].value
+    assert "%%WallPaperFish" in result.fields[1].value
+
+    result = asyncio.run(main.process_msg("%%(TinkerOS)Adma"))
+    assert "%%(TinkerOS)Adam" in result.fields[0].value
+
+
+def test_suggestions_build_in_the_background_and_keep_to_a_deadline(monkeypatch):
+    monkeypatch.setattr(main, "lookup_index", index.Index(*data.open_database()))
+    monkeypatch.setattr(main, "field_cache", main.cachetools.LRUCache(maxsize=16))
+
+    # The first miss starts the build, and isn't held up by it (or cached).
+    fields, suggestions = main.look_up_fields("TinkerOS", "Adma")
+    assert (fields, suggestions) == ((), ())
+    assert len(main.field_cache) == 0
+    version_index = main.lookup_index.version_index("TinkerOS")
+    version_index.build_suggestions()  # Waits for the background build.
+    assert main.look_up_fields("TinkerOS", "Adma") == ((), ("Adam",))
+    assert len(main.field_cache) == 1
+
+    assert version_index.suggestions.suggest("Adma", deadline=time.monotonic() - 1) is None
+
+
+def test_look_up_fields_are_cached_until_index_swapped():
+    main.field_cache.clear()
+    hits = main.field_cache_stats["hits"]
+
+    first = main.look_up_fields("TempleOS_5.3", "DocClear")
+    assert main.look_up_fields("TempleOS_5.3", "docclear") is first
+    assert main.field_cache_stats["hits"] == hits + 1
+
+    main.set_lookup_index(main.lookup_index)
+    assert len(main.field_cache) == 0
+
+    # Only an upper-case drive letter is stripped from a path needle.
+    assert main.look_up_fields("TempleOS_5.3", "C:/Adam")[0] != ()
+    assert main.look_up_fields("TempleOS_5.3", "c:/Adam")[0] == ()
+
+
+def test_look_up_many_matches_look_up():
+    needles = ["Adam", "charter", "::/Demo/*/*.HC", "c:/adam", "Nope", "Adam", "*Fish*"]
     for version in common.TOS_VERSIONS:
-        for s in data.get_all_symbols(version, main.db_con, main.db_cur):
-            r = asyncio.run(main.process_msg(f"Some text %%({version}){s['name']} ..."))
-            field_names = [f.name for f in r.fields]
-            assert s["name"] in field_names
+        expected = [data.look_up(version, n, main.db_con, main.db_cur) for n in needles]
+        assert data.look_up_many(version, needles, main.db_con, main.db_cur) == expected
+        assert main.lookup_index.look_up_many(version, needles) == expected
+
+
+def test_process_msg_looks_up_off_the_event_loop_in_one_batch(monkeypatch):
+    calls = []
+    look_up_many = main.lookup_index.look_up_many
+    def recording_look_up_many(TOS_version, needles):
+        calls.append((threading.current_thread(), needles))
+        return look_up_many(TOS_version, needles)
+
+    main.field_cache.clear()
+    monkeypatch.setattr(main.lookup_index, "look_up_many", recording_look_up_many)
+    asyncio.run(main.process_msg("%%Cd %%Dir %%cd"))
+    assert len(calls) == 1
+    assert calls[0][0] is not threading.main_thread()
+    assert calls[0][1] == ["Cd", "Dir"]
+
+
+def test_reload_index_swaps_in_a_new_index():
+    old_index = main.lookup_index
+    main.look_up_fields("TempleOS_5.3", "Adam")
+
+    asyncio.run(main.reload_index())
+    assert main.lookup_index is not old_index
+    assert len(main.field_cache) == 0
+    assert old_index.look_up("TempleOS_5.3", "Adam") == main.lookup_index.look_up("TempleOS_5.3", "Adam")
+    assert data.get_all_symbols("TinkerOS", main.db_con, main.db_cur) != []
+
+
+def test_failed_reload_keeps_the_old_index_and_versions(tmp_path, monkeypatch):
+    shutil.copytree("TOS_versions", tmp_path / "TOS_versions")
+    # A new version missing its Who.DD.
+    tmp_path.joinpath("TOS_versions", "NewOS").mkdir()
+    tmp_path.joinpath("TOS_versions", "NewOS", "meta.json").write_text('{"base_url": "x"}')
+    monkeypatch.chdir(tmp_path)
+    old_index, old_versions = main.lookup_index, list(common.TOS_VERSIONS)
+
+    replies_sent = []
+    async def reply(content, mention_author):
+        replies_sent.append(content)
+    msg = types.SimpleNamespace(content=common.RELOAD_COMMAND, reply=reply)
+    asyncio.run(main.handle_admin_command(msg))
+    assert replies_sent[0].startswith("Reload failed: ") and "Who.DD" in replies_sent[0]
+    assert main.lookup_index is old_index
+    assert common.TOS_VERSIONS == old_versions
+
+    processes = []
+    assert shards.restart_shards(processes, 2, 1) is processes
+    assert common.TOS_VERSIONS == old_versions
+
+
+def test_index_builds_versions_lazily_and_evicts_idle_ones():
+    con, cur = data.open_database()
+    lazy_index = index.Index(con, cur)
+    assert lazy_index.loaded_versions() == []
+    assert lazy_index.look_up("NoSuchVersion", "Adam") == ([], [])
+
+    lazy_index.look_up("tinkeros", "Adam")
+    assert lazy_index.loaded_versions() == ["TinkerOS"]
+    assert lazy_index.evict_idle(60) == []
+    assert lazy_index.evict_idle(0) == ["TinkerOS"]
+    assert lazy_index.look_up("TinkerOS", "Adam") == main.lookup_index.look_up("TinkerOS", "Adam")
+
+
+def test_index_loads_versions_through_its_own_cursor():
+    # Versions load on lookup threads while the event loop uses `db_cur`.
+    assert main.lookup_index.cur is not main.db_cur
+    assert main.lookup_index.con is not main.db_con
+
+    errors = []
+    def load_repeatedly():
+        try:
+            for _ in range(20):
+                main.lookup_index.evict_idle(0)
+                main.lookup_index.version_index("TinkerOS")
+        except Exception as e:
+            errors.append(e)
+    loader = threading.Thread(target=load_repeatedly)
+    loader.start()
+    while loader.is_alive():
+        data.get_random_symbol_or_path("TempleOS_5.3", main.db_con, main.db_cur)
+    loader.join()
+    assert errors == []
+
+
+def test_records_read_like_dicts_and_share_strings():
+    symbol = data.SymbolRecord("Cd", "/Kernel/BlkDev/DskDirB.HC.Z", 9, "Funct Public", "TinkerOS")
+    assert symbol["file"] == "/Kernel/BlkDev/DskDirB.HC.Z" and symbol["line"] == 9
+    assert symbol == dict(symbol) == {
+        "name": "Cd",
+        "file": "/Kernel/BlkDev/DskDirB.HC.Z",
+        "line": 9,
+        "type": "Funct Public",
+        "TOS_version": "TinkerOS"
+    }
+    with pytest.raises(KeyError):
+        symbol["nope"]
+
+    other = data.SymbolRecord("Dir", "/Kernel/BlkDev/DskDirB.HC.Z", 13, "Funct Public")
+    assert other.file_code == symbol.file_code and other.type_code == symbol.type_code
+    assert not hasattr(other, "__dict__")
+
+
+def test_snapshot_is_reused_until_sources_change(tmp_path):
+    snapshot_path = tmp_path / "index.sqlite3"
+    assert data.open_snapshot(snapshot_path) is None
+
+    con, cur = data.open_database(snapshot_path)
+    assert len(data.get_all_symbols("TinkerOS", con, cur)) > 0
+    con.close()
+
+    con = sqlite3.connect(snapshot_path)
+    con.execute("UPDATE snapshot_sources SET sha256 = 'stale'")
+    con.commit()
+    con.close()
+    assert data.open_snapshot(snapshot_path) is None
+    assert data.open_database(snapshot_path) is not None
+
+
+def test_ingestion_skips_malformed_lines_and_duplicate_paths(tmp_path, monkeypatch):
+    version_dir = tmp_path / "TOS_versions" / "Test"
+    version_dir.mkdir(parents=True)
+    (version_dir / "Who.DD").write_text(
+        "AAA                 0009D3B250    0000            OpCode \n"
+        "not a symbol line\n"
+    )
+    (version_dir / "Paths.DD").write_text(
+        '$LK,"C:/Adam/ABlkDev/Mount.HC",A="FI:C:/Adam/ABlkDev/Mount.HC"$\n'
+        "not a path line\n"
+        '$LK,"C:/Adam/ABlkDev/Mount.HC",A="FI:C:/Adam/ABlkDev/Mount.HC"$\n'
+    )
+    monkeypatch.chdir(tmp_path)
+
+    assert [s["name"] for s in data.get_symbols("Test")] == ["AAA"]
+    assert list(data.get_bare_paths("Test")) == [
+        "/Adam/ABlkDev/Mount.HC", "/Adam/ABlkDev", "/Adam", "/"
+    ]
+
+
+def test_process_msg_records_stage_metrics():
+    before = {
+        name: metrics.histograms[name].count if name in metrics.histograms else 0
+        for name in ["ttd2_extract_seconds", "ttd2_lookup_seconds", "ttd2_embed_seconds"]
+    }
+    asyncio.run(main.process_msg("%%Cd %%Dir"))
+    for name, count in before.items():
+        assert metrics.histograms[name].count == count + 1
+
+    text = metrics.render_prometheus()
+    assert 'ttd2_lookup_seconds_bucket{le="+Inf"}' in text
+    assert "# TYPE ttd2_field_cache_hits_total counter" in text
+    assert "# TYPE ttd2_message_queue_length gauge" in text
+    assert "ttd2_lookups_per_message" in metrics.render_summary()
+
+
+def test_on_ready_starts_background_tasks_and_servers_once(monkeypatch):
+    monkeypatch.setattr(common, "METRICS_PORT", test_utils.unused_port())
+    monkeypatch.setattr(common, "HTTP_PORT", test_utils.unused_port())
+    monkeypatch.setattr(main, "message_workers", [])
+    monkeypatch.setattr(main, "background_tasks", [])
+    monkeypatch.setattr(main, "servers", [])
+
+    async def change_presence(activity):
+        pass
+    application_info_calls = []
+    async def application_info():
+        application_info_calls.append(True)
+        return types.SimpleNamespace(team=None, owner=types.SimpleNamespace(id=7))
+    async def ready_twice():
+        monkeypatch.setattr(main, "client", types.SimpleNamespace(
+            loop=asyncio.get_running_loop(), change_presence=change_presence,
+            application_info=application_info
+        ))
+        # A second bind of either port would raise OSError.
+        await main.on_ready()
+        await main.on_ready()
+        assert len(main.message_workers) == common.MESSAGE_WORKERS
+        assert len(main.background_tasks) == 3  # Status, eviction, reply store flush.
+        assert len(main.servers) == 2
+        for runner in main.servers:
+            await runner.cleanup()
+
+        # Admin checks use the IDs fetched on ready, not a request each.
+        assert await main.is_admin(types.SimpleNamespace(id=7))
+        assert not await main.is_admin(types.SimpleNamespace(id=8))
+        assert len(application_info_calls) == 2
+    monkeypatch.setattr(main, "admin_ids", set())
+    asyncio.run(ready_twice())
+
+
+def test_token_bucket_refills_over_time():
+    now = [0]
+    bucket = throttle.TokenBucket(2, 0.5, clock=lambda: now[0])
+    assert bucket.take() and bucket.take() and not bucket.take()
+    now[0] = 2
+    assert bucket.take() and not bucket.take()
+    now[0] = 100
+    assert bucket.tokens <= 2 and bucket.take() and bucket.take() and not bucket.take()
+
+
+def test_on_message_coalesces_duplicates_and_sheds_floods_with_one_notice(monkeypatch):
+    notices = []
+    async def send(text):
+        notices.append(text)
+    channel = types.SimpleNamespace(id=1, send=send)
+    def message(author_id, content):
+        return types.SimpleNamespace(
+            channel=channel, author=types.SimpleNamespace(id=author_id), content=content,
+            id=len(notices)
+        )
+
+    monkeypatch.setattr(main, "recent_requests", main.cachetools.TTLCache(100, 60))
+    monkeypatch.setattr(main, "shed_notices", main.cachetools.TTLCache(100, 60))
+    monkeypatch.setattr(main, "channel_buckets", throttle.TokenBuckets(5, 0.001))
+    monkeypatch.setattr(main, "user_buckets", throttle.TokenBuckets(3, 0.001))
+    monkeypatch.setattr(main, "message_queue", asyncio.Queue(maxsize=100))
+
+    async def flood():
+        for _ in range(3):
+            await main.on_message(message(1, "%%Cd"))
+        for needle in ["Dir", "Adam", "Kernel", "Once"]:
+            await main.on_message(message(1, f"%%{needle}"))
+        await main.on_message(message(2, "no lookups here"))
+        # Another user asking the same is answered too.
+        await main.on_message(message(2, "%%Cd"))
+    asyncio.run(flood())
+
+    # Cd once (twice coalesced), then Dir and Adam until user 1's bucket ran
+    # out, then user 2's Cd.
+    assert main.message_queue.qsize() == 4
+    assert len(notices) == 1
+
+
+def test_reply_store_evicts_by_age_and_size_and_persists(tmp_path):
+    now = [0]
+    path = tmp_path.joinpath("replies.sqlite3")
+    store = replies.ReplyStore(path, maxsize=2, ttl=10, clock=lambda: now[0])
+    store.set(1, 10, 100)
+    now[0] = 5
+    store.set(1, 11, 101)
+    store.set(2, 12, 102)
+    assert store.get(1, 10) is None  # Over size.
+    assert store.get(1, 11).reply_id == 101
+    # Nothing reaches the file before a flush.
+    assert replies.ReplyStore(path, clock=lambda: now[0]).get(1, 11) is None
+    store.flush()
+
+    reopened = replies.ReplyStore(path, maxsize=2, ttl=10, clock=lambda: now[0])
+    assert (reopened.get(1, 11).reply_id, reopened.get(2, 12).reply_id) == (101, 102)
+    assert reopened.pop(1, 11).reply_id == 101 and reopened.pop(1, 11) is None
+    reopened.flush()
+    assert replies.ReplyStore(path, clock=lambda: now[0]).get(1, 11) is None
+    now[0] = 20
+    assert replies.ReplyStore(path, ttl=10, clock=lambda: now[0]).get(2, 12) is None
+
+
+def test_only_the_running_bot_opens_its_reply_store_file(tmp_path, monkeypatch):
+    # Importing `main` (as this file does) keeps replies in memory.
+    assert main.reply_store.con is None
+    monkeypatch.setattr(replies, "DEFAULT_PATH", tmp_path.joinpath("replies.sqlite3"))
+    monkeypatch.setattr(common, "SHARD_IDS", [0, 2])
+    monkeypatch.setattr(common, "SHARD_COUNT", 4)
+    monkeypatch.setattr(main, "reply_store", main.reply_store)
+    monkeypatch.setattr(main, "query_log", None)
+    main.open_files()
+    assert main.reply_store.con is not None
+    assert tmp_path.joinpath("replies-0-2-of-4.sqlite3").exists()
+
+
+def test_raw_message_delete_deletes_the_stored_reply(monkeypatch):
+    deleted = []
+    class Channel:
+        def get_partial_message(self, message_id):
+            async def delete():
+                deleted.append(message_id)
+            return types.SimpleNamespace(delete=delete)
+
+    monkeypatch.setattr(main, "reply_store", replies.ReplyStore())
+    monkeypatch.setattr(main.client, "get_partial_messageable", lambda channel_id: Channel())
+    main.reply_store.set(1, 10, 100)
+    payload = types.SimpleNamespace(channel_id=1, message_id=10)
+    asyncio.run(main.on_raw_message_delete(payload))
+    asyncio.run(main.on_raw_message_delete(payload))
+    assert deleted == [100]
+    assert len(main.reply_store) == 0
+
+
+def test_raw_message_edit_debounces_and_skips_unchanged_lookups(monkeypatch):
+    answered = []
+    async def enqueue_request(msg, answer, coalesce_key=None):
+        answered.append(msg.content)
+
+    monkeypatch.setattr(main.common, "EDIT_DEBOUNCE_SECONDS", 0.05)
+    monkeypatch.setattr(main, "reply_store", replies.ReplyStore())
+    monkeypatch.setattr(main, "enqueue_request", enqueue_request)
+    main.reply_store.set(1, 10, 100, [("", "Cd")])
+
+    def edit(content):
+        msg = types.SimpleNamespace(content=content, id=10, channel=types.SimpleNamespace(id=1))
+        return main.on_raw_message_edit(
+            types.SimpleNamespace(channel_id=1, message_id=10, message=msg)
+        )
+
+    async def edits():
+        # An unfurl: same lookups, nothing to do.
+        await edit("%%Cd https://example.com")
+        # A burst of edits is answered once, with the last.
+        await asyncio.gather(edit("%%Di"), edit("%%Dir"), edit("%%Dir %%Cd"))
+    asyncio.run(edits())
+    assert answered == ["%%Dir %%Cd"]
+
+
+def test_raw_message_edit_skips_unfurls_of_messages_not_yet_answered(monkeypatch):
+    monkeypatch.setattr(main.common, "EDIT_DEBOUNCE_SECONDS", 0)
+    monkeypatch.setattr(main, "reply_store", replies.ReplyStore())
+    monkeypatch.setattr(main, "requested_lookups", main.cachetools.TTLCache(100, 60))
+    monkeypatch.setattr(main, "recent_requests", main.cachetools.TTLCache(100, 60))
+    monkeypatch.setattr(main, "message_queue", asyncio.Queue(maxsize=100))
+    channel = types.SimpleNamespace(id=1)
+    def message(content, message_id=10, author_id=5):
+        return types.SimpleNamespace(
+            content=content, id=message_id, channel=channel,
+            author=types.SimpleNamespace(id=author_id)
+        )
+    def edit(content, message_id=10):
+        return main.on_raw_message_edit(types.SimpleNamespace(
+            channel_id=1, message_id=message_id, message=message(content, message_id)
+        ))
+
+    async def messages():
+        # Still queued when its link unfurls.
+        await main.on_message(message("%%Cd https://example.com"))
+        await edit("%%Cd https://example.com")
+        # Coalesced with the first, then unfurled.
+        await main.on_message(message("%%Cd https://example.com", 11))
+        await edit("%%Cd https://example.com", 11)
+        # A real change is still answered.
+        await edit("%%Dir https://example.com")
+    asyncio.run(messages())
+    assert main.message_queue.qsize() == 2
+
+
+def test_links_and_field_text_are_rendered_at_ingestion(tmp_path, monkeypatch):
+    paths, symbols = main.lookup_index.look_up("TinkerOS", "Cd")
+    cd = symbols[0]
+    assert cd.link == data.path_to_link(cd["file"], cd["line"], "TinkerOS")
+    assert cd.field_text.startswith("(Version: TinkerOS)\nType: ")
+    assert f"]({cd.link})" in cd.field_text
+    assert main.symbol_field(cd) == ("Cd", cd.field_text)
+    # The index renders its own, as the snapshot has them.
+    sql_cd = data.look_up("TinkerOS", "Cd", main.db_con, main.db_cur)[1][0]
+    assert (cd.link, cd.field_text) == (sql_cd.link, sql_cd.field_text)
+
+    # The default version is rendered into the text, so changing it is a rebuild.
+    snapshot_path = tmp_path / "index.sqlite3"
+    data.build_snapshot(snapshot_path)
+    monkeypatch.setattr(common, "DEFAULT_TOS_VERSION", "TinkerOS")
+    assert data.open_snapshot(snapshot_path) is None
+
+
+def test_cli_writes_one_json_line_per_lookup_in_order(tmp_path):
+    text = io.StringIO("See %%Cd and %%(TinkerOS)Dir.\nAnd %%(Nope)Cd, then %%cd.\n")
+    text.name = "post.txt"
+    out = io.StringIO()
+    cli.run(cli.read_items([text], True, ""), out, chunk_size=2)
+    results = [json.loads(line) for line in out.getvalue().splitlines()]
+
+    assert [(r["line"], r["needle"], r["TOS_version"]) for r in results] == [
+        (1, "Cd", "TempleOS_5.3"), (1, "Dir", "TinkerOS"), (2, "Cd", "Nope"), (2, "cd", "TempleOS_5.3")
+    ]
+    assert results[0]["symbols"][0]["link"].startswith(common.TOS_VERSION_BASE_URL_MAP["TempleOS_5.3"])
+    assert "error" in results[2]
+    assert results[3]["symbols"] == results[0]["symbols"]
+
+
+def test_http_service_answers_single_and_batch_lookups_from_the_shared_index():
+    async def requests():
+        app = server.make_app(lambda: main.lookup_index)
+        async with test_utils.TestClient(test_utils.TestServer(app)) as client:
+            single = await client.get("/lookup", params={"needle": "Cd", "version": "TinkerOS"})
+            batch = await client.post("/lookup/batch", json={
+                "lookups": [{"needle": "Cd"}, {"needle": "Cd", "version": "Nope"}, {"needle": ""}]
+            })
+            bad = await client.post("/lookup/batch", data="nope")
+            return (single.status, await single.json()), (batch.status, await batch.json()), bad.status
+
+    (status, single), (batch_status, batch), bad_status = asyncio.run(requests())
+    assert status == 200 and single["TOS_version"] == "TinkerOS" and single["found"]
+    assert single["symbols"] == [s.as_json() for s in main.lookup_index.look_up("TinkerOS", "Cd")[1]]
+
+    assert batch_status == 200
+    found, unknown_version, empty = batch["results"]
+    assert found["TOS_version"] == common.DEFAULT_TOS_VERSION and found["found"]
+    assert "error" in unknown_version and "error" in empty
+    assert bad_status == 400
+
+
+def test_all_versions_lookup_merges_identical_results_across_versions():
+    TOS_versions = main.lookup_index.store.TOS_versions
+    paths, symbols = main.lookup_index.look_up(common.ALL_TOS_VERSIONS, "Adam")
+
+    per_version = {v: main.lookup_index.look_up(v, "Adam") for v in TOS_versions}
+    assert len(symbols) == len({
+        (s["name"], s["file"], s["type"]) for _, ss in per_version.values() for s in ss
+    })
+    adam = symbols[0]
+    assert adam.versions == [v for v in TOS_versions if per_version[v][1]]
+    for v in adam.versions:
+        assert f"line {per_version[v][1][0]['line']}" in adam.field_text
+
+    embed = asyncio.run(main.process_msg("%%(*)Adam %%(*)Qzqzqz"))
+    assert embed.fields[0].value.startswith("Versions: ")
+    assert embed.fields[-1].value.startswith("(All versions)\n")
+
+
+def test_versions_share_one_stored_copy_of_each_record():
+    lookup_index = index.Index(*data.open_database())
+    [temple] = lookup_index.look_up("TempleOS_5.3", "Adam")[1]
+    [tinker] = lookup_index.look_up("TinkerOS", "Adam")[1]
+    [everywhere] = lookup_index.look_up(common.ALL_TOS_VERSIONS, "Adam")[1]
+    assert temple.stored() is tinker.stored() is everywhere.stored()
+    # Each version still reads as its own.
+    assert temple["line"] != tinker["line"]
+    assert (temple["TOS_version"], tinker["TOS_version"]) == ("TempleOS_5.3", "TinkerOS")
+    assert f"line {tinker['line']}" in tinker.field_text
+    assert f"line {tinker['line']}" not in temple.field_text
+
+    store = lookup_index.store
+    assert len(store.symbols) == len({
+        (s.name, s.file, s.type) for s in store.symbols
+    }) + len(store.symbol_repeats)
+    # A version reloaded after eviction adds none.
+    symbol_count = len(store.symbols)
+    lookup_index.evict_idle(0)
+    lookup_index.look_up("TinkerOS", "Adam")
+    assert len(store.symbols) == symbol_count
+
+
+def test_all_versions_lookup_names_each_version_once():
+    # ACBottomRight is listed twice in TinkerOS's Who.DD.
+    [symbol] = main.lookup_index.look_up(common.ALL_TOS_VERSIONS, "ACBottomRight")[1]
+    assert symbol.field_text.startswith("Versions: TinkerOS\n")
+
+    cross = main.lookup_index.version_index(common.ALL_TOS_VERSIONS)
+    for symbol in cross.symbols:
+        versions = symbol.field_text.split("\n")[0][len("Versions: "):].split(", ")
+        assert len(versions) == len(set(versions))
+        assert "TinkerOS, TinkerOS" not in symbol.field_text
+
+
+def test_directory_listings_count_files_beneath_and_fit_in_a_field():
+    version_index = main.lookup_index.version_index("TinkerOS")
+    for directory in version_index.paths:
+        if directory["type"] != "Directory" or directory["full_path"] == "/":
+            continue
+        listing = version_index.list_directory(directory["full_path"] + "/")
+        beneath = [
+            p for p in version_index.paths
+            if p["full_path"].startswith(directory["full_path"] + "/") and p["type"] != "Directory"
+        ]
+        assert sum(listing.type_counts.values()) == len(beneath)
+        assert len(listing.subdirectories) + len(listing.files) == len([
+            p for p in version_index.paths
+            if p["full_path"].rpartition("/")[0] == directory["full_path"]
+        ])
+        name, text = main.directory_listing_field(listing, "TinkerOS")
+        assert name == directory["full_path"] + "/"
+        assert len(text) <= main.MAX_FIELD_VALUE_LEN
+
+    embed = asyncio.run(main.process_msg("%%::/Demo/Graphics/ %%/Demo/Nope/"))
+    assert embed.fields[0].name == "/Demo/Graphics/" and "Files beneath: " in embed.fields[0].value
+    assert embed.fields[1].name == "Not found."
+
+
+def shard_look_up(shared_index, queue):
+    shared_index.reconnect(*data.open_database())
+    queue.put([dict(s) for s in shared_index.look_up("TinkerOS", "Cd")[1]])
+
+
+# Set before forking; stand-in shards report to it.
+shard_reports = None
+
+def shard_report_and_wait(process_number, shard_ids, shard_count, shared_index, reload_requests):
+    shared_index.reconnect(*data.open_database())
+    cd = shared_index.look_up("TinkerOS", "Cd")[1]
+    shard_reports.put((shard_ids, id(shared_index), os.getpid(), len(cd)))
+    time.sleep(60)
+
+
+def test_shard_processes_share_one_prebuilt_index():
+    assert shards.split_shards(5, 2) == [[0, 2, 4], [1, 3]]
+
+    shared_index = shards.build_shared_index()
+    assert set(shared_index.loaded_versions()) == {*common.TOS_VERSIONS, common.ALL_TOS_VERSIONS}
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    process = context.Process(target=shard_look_up, args=(shared_index, queue))
+    process.start()
+    result = queue.get(timeout=30)
+    process.join()
+    assert result == [dict(s) for s in main.lookup_index.look_up("TinkerOS", "Cd")[1]]
+
+
+def test_sharded_reload_restarts_every_shard_with_one_new_index(monkeypatch):
+    global shard_reports
+    shard_reports = multiprocessing.get_context("fork").Queue()
+    processes = shards.start_shards(4, 2, target=shard_report_and_wait)
+    restarted = []
+    try:
+        first = [shard_reports.get(timeout=30) for _ in processes]
+        restarted = shards.restart_shards(processes, 4, 2, target=shard_report_and_wait)
+        assert not any(p.is_alive() for p in processes)
+        second = [shard_reports.get(timeout=30) for _ in restarted]
+    finally:
+        shards.stop_shards(processes)
+        shards.stop_shards(restarted)
+        gc.unfreeze()
+
+    assert sorted(r[0] for r in second) == [[0, 2], [1, 3]]
+    # One index per generation, shared by all of its shards.
+    assert len({r[1] for r in first}) == len({r[1] for r in second}) == 1
+    assert {p.pid for p in processes} == {r[2] for r in first}
+    assert {p.pid for p in restarted} == {r[2] for r in second}
+    assert all(r[3] > 0 for r in first + second)
+
+    # A shard asked to reload leaves it to `shards.py`, asking over a pipe.
+    receiver, sender = multiprocessing.get_context("fork").Pipe(duplex=False)
+    monkeypatch.setattr(common, "SHARD_COUNT", 4)
+    monkeypatch.setattr(main, "shard_reload_requests", sender)
+    old_index = main.lookup_index
+    asyncio.run(main.reload_index())
+    assert receiver.poll(1)
+    assert main.lookup_index is old_index
+
+
+# Set before forking; the first stand-in shard to find it missing asks for a
+# reload, then waits to be restarted (failing if it isn't).
+shard_reload_marker = None
+
+def shard_ask_for_reload_once(process_number, shard_ids, shard_count, shared_index, reload_requests):
+    if not shard_reload_marker.exists():
+        shard_reload_marker.touch()
+        reload_requests.send(None)
+        time.sleep(30)
+        raise SystemExit(3)
+
+
+def test_supervise_restarts_shards_when_one_asks(tmp_path):
+    global shard_reload_marker
+    shard_reload_marker = tmp_path.joinpath("asked")
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGHUP, signal.SIGTERM)}
+    try:
+        assert shards.supervise(2, 1, target=shard_ask_for_reload_once) == 0
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+        gc.unfreeze()
+    assert shard_reload_marker.exists()
+
+
+# Query log and replay =========================================================
+
+def test_query_log_records_answered_messages_for_replay(tmp_path, monkeypatch):
+    path = tmp_path.joinpath("queries.jsonl")
+    monkeypatch.setattr(main, "query_log", querylog.QueryLog(path))
+    monkeypatch.setattr(main, "reply_store", replies.ReplyStore())
+    async def reply(embed, mention_author):
+        return types.SimpleNamespace(id=100)
+    def message(content, sent_at):
+        return types.SimpleNamespace(
+            content=content, id=10, reply=reply, edited_at=None,
+            created_at=datetime.datetime.fromtimestamp(sent_at, datetime.timezone.utc),
+            channel=types.SimpleNamespace(id=1), guild=types.SimpleNamespace(id=2)
+        )
+
+    async def answer_all():
+        await main.answer_message(message("See %%Cd and %%(NoSuchOS)Dir.", 1000))
+        monkeypatch.setattr(common, "SLOW_QUERY_SECONDS", 0)
+        await main.answer_message(message("%%(TinkerOS)*Fish*", 1000.5))
+    asyncio.run(answer_all())
+    main.query_log.flush()
+
+    first, second = querylog.read(path)
+    assert (first["time"], first["guild_id"], first["channel_id"]) == (1000, 2, 1)
+    assert first["lookups"] == [["", "Cd"], ["NoSuchOS", "Dir"]]
+    assert first["results"] == [1, None]
+    assert set(first["stages"]) == {"extract", "lookup", "embed"}
+    assert not first["slow"] and "plan" not in first
+    assert second["slow"]
+    assert second["plan"][0]["paths"] == {"key": "basename", "method": "like", "candidates": 1}
+
+    records = list(querylog.read(path))
+    latencies, elapsed = asyncio.run(replay.replay(records, speed=0))
+    summary = replay.summarize(records, latencies, elapsed)
+    assert (summary["messages"], summary["lookups"]) == (2, 3)
+    assert 0 < summary["p50"] <= summary["max"] <= elapsed
+
+
+def test_query_plans_never_build_versions():
+    new_index = index.Index(*data.open_database())
+    assert new_index.explain("TinkerOS", "Cd") == {}
+    assert not new_index.is_loaded("TinkerOS")
+    new_index.version_index("TinkerOS")
+    assert new_index.explain("TinkerOS", "Cd")["symbols"] == {"method": "exact"}
+
+
+# Slash command ================================================================
+
+def test_slash_command_autocompletes_ranked_names_and_paths(monkeypatch):
+    version_index = main.lookup_index.version_index(common.DEFAULT_TOS_VERSION)
+    ranks = {s["name"]: index.completion_rank(s["type"]) for s in version_index.symbols}
+    completions = version_index.complete("str")
+    assert completions[0] == "StrCmp"
+    assert [ranks.get(c, 2) for c in completions] == sorted(ranks.get(c, 2) for c in completions)
+
+    # Stored tops (short prefixes) and scanned ones (long) both match a full sort.
+    version_index.complete("/")
+    for completer, prefixes in [
+        (version_index.name_completions, ["", "d", "doc", "docc", "wallpaperf", "qqq"]),
+        (version_index.path_completions, ["/", "/demo/", "/kernel/km"]),
+    ]:
+        for prefix in prefixes:
+            expected = sorted(o for o in completer.orders if o[2].startswith(prefix))
+            assert completer.complete(prefix) == [o[3] for o in expected[:index.MAX_COMPLETIONS]]
+
+    sent = []
+    async def send_message(content=None, embed=None, ephemeral=False):
+        sent.append(embed)
+    interaction = types.SimpleNamespace(
+        namespace=types.SimpleNamespace(version="TinkerOS"),
+        channel_id=1, guild_id=2, user=types.SimpleNamespace(id=3),
+        created_at=datetime.datetime.now(datetime.timezone.utc),
+        response=types.SimpleNamespace(send_message=send_message)
+    )
+    choices = asyncio.run(main.ttd_needle_autocomplete(interaction, "C:/Demo/Graphics/WallpaperF"))
+    assert [c.value for c in choices] == ["/Demo/Graphics/WallPaperFish.HC"]
+    choices = asyncio.run(main.ttd_version_autocomplete(interaction, "tink"))
+    assert [c.value for c in choices] == ["TinkerOS"]
+
+    monkeypatch.setattr(main, "channel_buckets", throttle.TokenBuckets(5, 0.001))
+    asyncio.run(main.ttd_command.callback(interaction, "WallPaperFish", "TinkerOS"))
+    assert [f.name for f in sent[0].fields] == ["WallPaperFish.HC"]
+
+
+def test_slash_command_rejects_bad_needles_and_defers_unloaded_versions(monkeypatch):
+    sent = []
+    async def send_message(content=None, embed=None, ephemeral=False):
+        sent.append(("response", content, embed, ephemeral))
+    async def defer():
+        sent.append(("defer",))
+    async def send(embed):
+        sent.append(("followup", None, embed, False))
+    interaction = types.SimpleNamespace(
+        channel_id=1, guild_id=2, user=types.SimpleNamespace(id=3),
+        created_at=datetime.datetime.now(datetime.timezone.utc),
+        response=types.SimpleNamespace(send_message=send_message, defer=defer),
+        followup=types.SimpleNamespace(send=send)
+    )
+    monkeypatch.setattr(main, "channel_buckets", throttle.TokenBuckets(5, 0.001))
+    monkeypatch.setattr(main, "lookup_index", index.Index(*data.open_database()))
+
+    # Nothing a `%%` lookup couldn't ask for; "%" would match every symbol.
+    for needle in ["%", "Str%", "Cd.", "", "Doc Clear"]:
+        asyncio.run(main.ttd_command.callback(interaction, needle, "TinkerOS"))
+        assert sent.pop()[3]  # Ephemeral.
+    assert not main.lookup_index.is_loaded("TinkerOS")
+
+    # Building the version first might take longer than Discord waits.
+    asyncio.run(main.ttd_command.callback(interaction, "Cd", "TinkerOS"))
+    assert [s[0] for s in sent] == ["defer", "followup"]
+    assert sent[1][2].fields[0].name == "Cd"
+    sent.clear()
+    asyncio.run(main.ttd_command.callback(interaction, " Cd ", "TinkerOS"))
+    assert [s[0] for s in sent] == ["response"]
 
 
 # Hypothesis ===================================================================
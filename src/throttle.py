@@ -0,0 +1,66 @@
+""" Rate limiting for incoming lookup requests. """
+
+import time
+
+import cachetools
+
+# =============================================================================
+
+class TokenBucket:
+    """ Holds up to `capacity` tokens, refilled at `rate` tokens per second. """
+
+    def __init__(self, capacity, rate, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = rate
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, cost=1):
+        self.refill()
+        return self.tokens >= cost
+
+    def take(self, cost=1):
+        """ Spend `cost` tokens if there are that many; return whether it did. """
+        if not self.available(cost):
+            return False
+        self.tokens -= cost
+        return True
+
+
+class TokenBuckets:
+    """ One `TokenBucket` per key (channel, user...), made on first use.
+
+    A bucket left alone long enough to refill completely is no different from
+    a new one, so it's forgotten then; at most `max_keys` are kept regardless.
+    """
+
+    def __init__(self, capacity, rate, max_keys=10_000, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = rate
+        self.clock = clock
+        self.buckets = cachetools.TTLCache(
+            maxsize=max_keys, ttl=capacity / rate, timer=clock
+        )
+
+    def __getitem__(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.capacity, self.rate, self.clock)
+        # (Re)inserting restarts the key's time to live.
+        self.buckets[key] = bucket
+        return bucket
+
+
+def take_all(buckets, cost=1):
+    """ Spend `cost` from every bucket, or from none if any is short. """
+    if all(bucket.available(cost) for bucket in buckets):
+        for bucket in buckets:
+            bucket.take(cost)
+        return True
+    return False